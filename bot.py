@@ -11,30 +11,39 @@ Features:
 - All handlers and DB calls protected; no nested handlers; proper async/await usage
 """
 import random
+import re
 import os
 import io
 import time
+import asyncio
+import tempfile
 import zipfile
 import logging
 import shutil
 import sqlite3
+import threading
 import unicodedata
-from datetime import datetime, date
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from datetime import datetime, date, time as dt_time, timedelta
 from typing import List, Dict, Any, Optional
 from dotenv import load_dotenv
 
 load_dotenv()
 
-import pandas as pd
 
 # Additional imports for charts and PNG generation
 import matplotlib
 
 matplotlib.use('Agg')  # non-interactive backend for servers
-import matplotlib.pyplot as plt
+# bundled font with Cyrillic glyphs: labels render without font fallback lookups
+matplotlib.rcParams.update({'font.family': 'DejaVu Sans', 'axes.unicode_minus': False})
+from matplotlib.figure import Figure
 from io import BytesIO as _BytesIO
 from aiogram import Bot, Dispatcher, types
 from aiogram.utils import executor
+from aiogram.utils.exceptions import RetryAfter
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, InputFile
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
@@ -43,8 +52,9 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("homework-bot")
 
 # additional imports for Excel styling and reports
-from openpyxl import load_workbook
-from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, Alignment, PatternFill, Border, Side, NamedStyle
 from openpyxl.utils import get_column_letter
 
 # Reports directory
@@ -75,61 +85,169 @@ if ADMIN_ID == 0:
     logger.warning("ADMIN_ID is 0 or not set. Set ADMIN_ID env var (your Telegram id).")
 
 # ---------------- BOT / DISPATCHER / SCHEDULER ----------------
-bot = Bot(token=API_TOKEN)
+# concurrent broadcast sends (Telegram allows ~30 msg/s); the HTTP pool keeps headroom
+# above it for polling, uploads and handler replies
+BROADCAST_LIMIT = 25
+bot = Bot(token=API_TOKEN, connections_limit=BROADCAST_LIMIT + 10)
 dp = Dispatcher(bot, storage=MemoryStorage())
 scheduler = AsyncIOScheduler()
 
+class TTLDict(OrderedDict):
+    """Dict for in-memory flow state: entries expire ttl seconds after their last write, size is capped.
+
+    Expiry happens in expire(), called periodically; the oldest writes go first when the cap is hit.
+    """
+
+    def __init__(self, ttl: float, maxlen: int = 10_000):
+        super().__init__()
+        self.ttl = ttl
+        self.maxlen = maxlen
+        self._stamps: "OrderedDict[Any, float]" = OrderedDict()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        self._stamps[key] = time.time()
+        self._stamps.move_to_end(key)
+        while len(self) > self.maxlen:
+            self.popitem(last=False)
+
+    def expire(self, now: float = None):
+        now = now or time.time()
+        # _stamps is ordered by write time; stamps of keys popped elsewhere are dropped on the way
+        while self._stamps:
+            key, t = next(iter(self._stamps.items()))
+            if key in self and now - t < self.ttl:
+                break
+            self._stamps.popitem(last=False)
+            self.pop(key, None)
+
+
 # in-memory flows
-pending: Dict[str, Dict[str, Any]] = {}  
-admin_pending: Dict[str, Dict[str, Any]] = {} 
-media_groups: Dict[str, Dict[str, Any]] = {}  
-reasons_pending: Dict[str, str] = {}  
+pending: Dict[str, Dict[str, Any]] = TTLDict(ttl=3600)
+admin_pending: Dict[str, Dict[str, Any]] = TTLDict(ttl=3600)
+media_groups: Dict[str, Dict[str, Any]] = TTLDict(ttl=3600)
+# asked at 23:57, answers may come the next day
+reasons_pending: Dict[str, str] = TTLDict(ttl=24 * 3600)
+
+
+def expire_flow_state():
+    now = time.time()
+    for d in (pending, admin_pending, media_groups, reasons_pending, _ensured_users):
+        d.expire(now)
 
 
 # ---------------- UTIL ----------------
+# local date string, recomputed only after the next local midnight
+_today_cache = {"until": 0.0, "val": ""}
+
+
 def today_str() -> str:
-    return date.today().isoformat()
+    now = time.time()
+    if now >= _today_cache["until"]:
+        d = date.fromtimestamp(now)
+        _today_cache["val"] = d.isoformat()
+        _today_cache["until"] = datetime.combine(d + timedelta(days=1), dt_time.min).timestamp()
+    return _today_cache["val"]
 
 
 def ensure_dir(path: str):
     os.makedirs(path, exist_ok=True)
 
 
+_SLUG_ALLOWED = frozenset("-_.() abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 ")
+# ASCII-only table: path separators become "_", every other disallowed char is deleted
+_SLUG_TABLE = {c: None for c in range(128) if chr(c) not in _SLUG_ALLOWED}
+_SLUG_TABLE.update({ord("/"): "_", ord("\\"): "_"})
+
+
 def slugify_filename(s: str) -> str:
-    s = unicodedata.normalize('NFKD', s)
-    s = "".join(c for c in s if not unicodedata.combining(c))
-    s = s.replace("/", "_").replace("\\", "_")
-    allowed = "-_.() abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 "
-    return "".join(c for c in s if c in allowed)[:200] or "file"
+    # everything allowed is ASCII, so combining marks and other non-ASCII chars can be dropped
+    # by the codec in C; translate then handles the rest in a single pass
+    s = unicodedata.normalize('NFKD', s).encode("ascii", "ignore").decode("ascii")
+    return s.translate(_SLUG_TABLE)[:200] or "file"
+
+
+# the first separator picks the only format that can match; "-" covers non-padded input like 2024-1-5
+_DATE_SEP_RE = re.compile(r"[./-]")
+_DATE_FORMATS = {".": "%d.%m.%Y", "/": "%d/%m/%Y", "-": "%Y-%m-%d"}
 
 
 def parse_date(text: str) -> Optional[date]:
     text = (text or "").strip()
-    for fmt in ("%Y-%m-%d", "%d.%m.%Y", "%d/%m/%Y"):
-        try:
-            return datetime.strptime(text, fmt).date()
-        except Exception:
-            pass
-    return None
+    # YYYY-MM-DD — самый частый случай, без strptime
+    try:
+        return date.fromisoformat(text)
+    except ValueError:
+        pass
+    m = _DATE_SEP_RE.search(text)
+    if not m:
+        return None
+    try:
+        return datetime.strptime(text, _DATE_FORMATS[m.group()]).date()
+    except ValueError:
+        return None
 
 
 # ---------------- USERNAME HELPERS ----------------
-def get_username_by_id(user_id: int) -> str:
+# uid -> (username, first_name); bulk-loaded for reports, dropped whenever a user row changes
+_user_cache: Dict[int, tuple] = {}
+# uid -> ready mention HTML, dropped together with _user_cache
+_mention_cache: Dict[int, str] = {}
+
+
+def load_user_names(db: sqlite3.Connection) -> Dict[int, tuple]:
+    """uid -> (username, first_name) for every user in one SELECT, as a local snapshot for reports.
+
+    Runs on worker threads, so it leaves _user_cache / _mention_cache (event loop only) alone.
+    """
+    rows = db.execute('SELECT id, username, first_name FROM users').fetchall()
+    return {r[0]: (r[1], r[2]) for r in rows}
+
+
+def invalidate_user_cache(user_id: int = None):
+    if user_id is None:
+        _user_cache.clear()
+        _mention_cache.clear()
+    else:
+        _user_cache.pop(int(user_id), None)
+        _mention_cache.pop(int(user_id), None)
+
+
+def cache_user(user_id: int, username: str, first_name: str):
+    """Store the row just written for user_id, so the next lookup needs no SELECT."""
+    user_id = int(user_id)
+    if _user_cache.get(user_id) != (username, first_name):
+        _user_cache[user_id] = (username, first_name)
+        _mention_cache.pop(user_id, None)
+
+
+async def get_cached_user(user_id: int) -> Optional[tuple]:
+    """Return (username, first_name) from the cache, reading the row once on a miss."""
+    cached = _user_cache.get(user_id)
+    if cached is not None:
+        return cached
+    result = await db_fetchone('SELECT username, first_name FROM users WHERE id = ?', (user_id,))
+    if result:
+        _user_cache[user_id] = tuple(result)
+        return _user_cache[user_id]
+    return None
+
+
+async def get_username_by_id(user_id: int) -> str:
     
     try:
-        cursor.execute('SELECT username FROM users WHERE id = ?', (user_id,))
-        result = cursor.fetchone()
+        result = await get_cached_user(user_id)
         return result[0] if result else ""
     except Exception as e:
         logger.exception(f"Error getting username for user_id {user_id}")
         return ""
 
 
-def get_user_display_name_by_id(user_id: int) -> str:
+async def get_user_display_name_by_id(user_id: int) -> str:
     
     try:
-        cursor.execute('SELECT username, first_name FROM users WHERE id = ?', (user_id,))
-        result = cursor.fetchone()
+        result = await get_cached_user(user_id)
         if result:
             username, first_name = result
             return username if username else (first_name if first_name else f"user_{user_id}")
@@ -139,30 +257,88 @@ def get_user_display_name_by_id(user_id: int) -> str:
         return f"user_{user_id}"
 
 
-def mention_html(user: types.User = None, user_id: int = None) -> str:
+async def mention_html_by_id(user_id: int) -> str:
     
-    if user:
-        name = (user.username and f"@{user.username}") or (user.first_name or f"user_{user.id}")
-        return f"<a href='tg://user?id={user.id}'>{name}</a>"
-    elif user_id:
-        display_name = get_user_display_name_by_id(user_id)
-        return f"<a href='tg://user?id={user_id}'>{display_name}</a>"
-    else:
-        return "Неизвестный пользователь"
+    html = _mention_cache.get(user_id)
+    if html is None:
+        html = f"<a href='tg://user?id={user_id}'>{await get_user_display_name_by_id(user_id)}</a>"
+        _mention_cache[user_id] = html
+    return html
 
 
-def mention_html_by_id(user_id: int) -> str:
-    
-    display_name = get_user_display_name_by_id(user_id)
-    return f"<a href='tg://user?id={user_id}'>{display_name}</a>"
+# ---------------- DB ----------------
+def configure_connection(db: sqlite3.Connection):
+    # WAL + NORMAL sync: one fsync per checkpoint instead of per commit, readers don't block the writer
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("PRAGMA temp_store=MEMORY")
+    db.execute("PRAGMA cache_size=-65536")
+    # 256 MB mmap: reads come straight from the page cache without read() copies
+    db.execute("PRAGMA mmap_size=268435456")
 
 
-# ---------------- DB ----------------
-conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-cursor = conn.cursor()
+_thread_local = threading.local()
+
+
+def thread_db() -> sqlite3.Connection:
+    """Connection owned by the calling thread: db_executor workers and to_thread jobs (reports, exports).
+
+    There is no shared connection; WAL lets these readers and the single writer run side by side.
+    """
+    db = getattr(_thread_local, "conn", None)
+    if db is None:
+        db = sqlite3.connect(DB_FILE)
+        configure_connection(db)
+        _thread_local.conn = db
+    return db
+
+
+# handler-side reads and writes run here on thread_db() connections, so the event loop never waits on SQLite I/O
+db_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="db")
+
+
+async def db_call(fn, *args):
+    """Run fn(db, *args) on a db_executor thread with that thread's connection."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, lambda: fn(thread_db(), *args))
+
+
+def _exec_commit(db: sqlite3.Connection, sql: str, params: tuple):
+    db.execute(sql, params)
+    db.commit()
+
+
+async def db_exec(sql: str, params: tuple = ()):
+    await db_call(_exec_commit, sql, params)
+
+
+async def db_fetchone(sql: str, params: tuple = ()):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, lambda: thread_db().execute(sql, params).fetchone())
+
+
+async def db_fetchall(sql: str, params: tuple = ()) -> list:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, lambda: thread_db().execute(sql, params).fetchall())
+
+
+@contextmanager
+def db_transaction(db: sqlite3.Connection, mode: str = "DEFERRED"):
+    """Run the enclosed statements in one explicit transaction (one commit, one consistent snapshot)."""
+    db.execute(f"BEGIN {mode}")
+    try:
+        yield db
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
 
 
 def init_db():
+    # schema setup at import, on a short-lived connection of its own
+    db = sqlite3.connect(DB_FILE)
+    configure_connection(db)
+    cursor = db.cursor()
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS users (
         id INTEGER PRIMARY KEY,
@@ -195,11 +371,44 @@ def init_db():
         PRIMARY KEY (user_id, date)
     )
     ''')
-    conn.commit()
+    # latest-submission-of-the-day lookups become a descending index range scan
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sub_user_date_ts ON submissions(user_id, date, ts DESC)')
+    # (date, type) covers per-day counts by type and the per-date chart groupings; it supersedes idx_sub_date
+    cursor.execute('DROP INDEX IF EXISTS idx_sub_date')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sub_date_type ON submissions(date, type)')
+    # rows of full_history.xlsx; the sheet is regenerated from here
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS full_history (
+        user_id INTEGER,
+        date TEXT,
+        name TEXT,
+        tag TEXT,
+        dz INTEGER,
+        conspect INTEGER,
+        miss_reason TEXT,
+        task_flag TEXT,
+        message_id INTEGER,
+        PRIMARY KEY (user_id, date)
+    )
+    ''')
+    # miss_reasons(user_id, date) is already covered by its primary key
+    # case-insensitive name lookups (export / delete by username)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_username_ci ON users(LOWER(username))')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_firstname_ci ON users(LOWER(first_name))')
+    db.commit()
+    # refresh planner statistics so the new indexes are picked up
+    cursor.execute('ANALYZE')
+    db.commit()
+    db.close()
 
 
 init_db()
 
+# one indexed probe per column instead of an OR across both
+USER_BY_NAME_SQL = ('SELECT id, username, first_name FROM users WHERE LOWER(username) = LOWER(?) '
+                    'UNION SELECT id, username, first_name FROM users WHERE LOWER(first_name) = LOWER(?) '
+                    'ORDER BY id LIMIT 1')
+
 # ---------------- TOPICS ----------------
 SECTIONS = {
     "Основы Питона": [
@@ -216,28 +425,27 @@ SECTIONS = {
     ]
 }
 
+# text/caption starting with one of these is taken as a submission without a chosen topic
+KIND_PREFIXES = ("дз", "конспект")
+
+# (section, topic_id) -> topic, for callback lookups
+TOPIC_INDEX = {(sec, t["id"]): t for sec, topics in SECTIONS.items() for t in topics}
+
 
 # USER / SUBMISSION HELPERS
-def ensure_user_record_obj(user: types.User):
-    try:
-        cursor.execute('INSERT OR IGNORE INTO users (id, username, first_name) VALUES (?, ?, ?)',
-                       (user.id, user.username or "", user.first_name or ""))
-        cursor.execute('UPDATE users SET username = ?, first_name = ? WHERE id = ?',
-                       (user.username or "", user.first_name or "", user.id))
-        conn.commit()
-    except Exception:
-        logger.exception("ensure_user_record_obj error")
+# handler writes go through db_call: the commit (and its fsync) happens on a db_executor thread
+# the WHERE makes a repeat call with unchanged data a no-op instead of a row rewrite
+UPSERT_USER_SQL = ('INSERT INTO users (id, username, first_name) VALUES (?, ?, ?) '
+                   'ON CONFLICT(id) DO UPDATE SET username = excluded.username, first_name = excluded.first_name '
+                   'WHERE users.username IS NOT excluded.username OR users.first_name IS NOT excluded.first_name')
 
 
-def ensure_user_record_by_id(uid: int, username: str = "", first_name: str = ""):
+async def ensure_user_record_obj(user: types.User):
     try:
-        cursor.execute('INSERT OR IGNORE INTO users (id, username, first_name) VALUES (?, ?, ?)',
-                       (uid, username, first_name))
-        cursor.execute('UPDATE users SET username = ?, first_name = ? WHERE id = ?',
-                       (username or "", first_name or "", uid))
-        conn.commit()
+        await db_exec(UPSERT_USER_SQL, (user.id, user.username or "", user.first_name or ""))
+        cache_user(user.id, user.username or "", user.first_name or "")
     except Exception:
-        logger.exception("ensure_user_record_by_id error")
+        logger.exception("ensure_user_record_obj error")
 
 
 async def ensure_user_with_current_data(user_id: int, bot_instance: Bot = None):
@@ -252,48 +460,196 @@ async def ensure_user_with_current_data(user_id: int, bot_instance: Bot = None):
             user = chat_member.user
         except:
             # Если не получается через get_chat_member, используем существующие данные из БД
-            cursor.execute('SELECT username, first_name FROM users WHERE id = ?', (user_id,))
-            result = cursor.fetchone()
+            result = await db_fetchone('SELECT username, first_name FROM users WHERE id = ?', (user_id,))
             if result:
-                username, first_name = result
+                cache_user(user_id, *result)
                 return
             else:
                 # Если нет данных в БД, создаем базовую запись
-                cursor.execute('INSERT OR IGNORE INTO users (id, username, first_name) VALUES (?, ?, ?)',
-                               (user_id, "", f"user_{user_id}"))
-                conn.commit()
+                await db_exec('INSERT OR IGNORE INTO users (id, username, first_name) VALUES (?, ?, ?)',
+                              (user_id, "", f"user_{user_id}"))
+                # IGNORE: a row written concurrently may differ, so read it back on the next lookup
+                invalidate_user_cache(user_id)
                 return
 
         # Обновляем запись в базе данных
-        cursor.execute(
+        await db_exec(
             'INSERT OR REPLACE INTO users (id, username, first_name) VALUES (?, ?, ?)',
             (user.id, user.username or "", user.first_name or "")
         )
-        conn.commit()
+        cache_user(user.id, user.username or "", user.first_name or "")
         logger.info(f"Updated user data: {user.id}, @{user.username}, {user.first_name}")
 
     except Exception as e:
         logger.exception(f"Error ensuring user data for {user_id}")
 
 
-def add_submission_obj(user: types.User, submission: dict, message_id: int = None):
-    ensure_user_record_obj(user)
+ENSURE_USER_TTL = 300
+# uid -> time of the last refresh done for an admin notification; expired with the flow state
+_ensured_users: Dict[int, float] = TTLDict(ttl=ENSURE_USER_TTL)
+
+
+async def notify_admin(user_id: int, icon: str = "", text: str = "", forward: types.Message = None):
+    """Tell the admin about a submission: "<icon> <mention> <text>", and/or forward the original message."""
     try:
-        cursor.execute('''
-            INSERT INTO submissions (
-                user_id, type, section, topic_id, topic_title, content_type, 
-                content_summary, photo_file_id, message_id, date, ts
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            user.id, submission['type'], submission['section'], submission['topic_id'],
-            submission['topic_title'], submission['content_type'], submission.get('content_summary', ''),
-            submission.get('photo_file_id', ''), message_id, submission['date'], submission['ts']
-        ))
-        conn.commit()
+        # Обновляем данные пользователя перед отправкой уведомления админу (не чаще раза в ENSURE_USER_TTL)
+        if time.time() - _ensured_users.get(user_id, 0) >= ENSURE_USER_TTL:
+            await ensure_user_with_current_data(user_id)
+            _ensured_users[user_id] = time.time()
+        if text:
+            await bot.send_message(ADMIN_ID, f"{icon} {await mention_html_by_id(user_id)} {text}", parse_mode="HTML")
+        if forward is not None:
+            await bot.forward_message(ADMIN_ID, forward.chat.id, forward.message_id)
+    except Exception:
+        pass
+
+
+# fire-and-forget tasks; the set keeps them referenced until they finish
+_background_tasks = set()
+
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+INSERT_SUBMISSION_SQL = '''
+    INSERT INTO submissions (
+        user_id, type, section, topic_id, topic_title, content_type, 
+        content_summary, photo_file_id, message_id, date, ts
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+
+def _submission_params(user_id: int, submission: dict, message_id: int = None) -> tuple:
+    return (
+        user_id, submission['type'], submission['section'], submission['topic_id'],
+        submission['topic_title'], submission['content_type'], submission.get('content_summary', ''),
+        submission.get('photo_file_id', ''), message_id, submission['date'], submission['ts']
+    )
+
+
+def _drain_queue(q: asyncio.Queue, batch: list, limit: int) -> list:
+    while len(batch) < limit:
+        try:
+            batch.append(q.get_nowait())
+        except asyncio.QueueEmpty:
+            break
+    return batch
+
+
+# group commit: submissions arriving within SUBMISSION_BATCH_WINDOW share one transaction (one fsync);
+# each caller still waits on its future until the commit that holds its row is done
+submission_write_q: "asyncio.Queue[tuple]" = asyncio.Queue()
+SUBMISSION_BATCH_MAX = 200
+SUBMISSION_BATCH_WINDOW = 0.05
+
+
+def _flush_submissions(db: sqlite3.Connection, batch: List[tuple]):
+    with db_transaction(db, "IMMEDIATE"):
+        db.executemany(UPSERT_USER_SQL, [b[0] for b in batch])
+        db.executemany(INSERT_SUBMISSION_SQL, [b[1] for b in batch])
+
+
+def _settle_batch(batch: List[tuple], commit: asyncio.Future):
+    error = commit.exception()
+    for *_, fut in batch:
+        if fut.done():
+            continue
+        if error is not None:
+            fut.set_exception(error)
+        else:
+            fut.set_result(None)
+
+
+async def _commit_batch(flush, batch: List[tuple]):
+    """Run flush(db, batch) on a DB thread and resolve the future that ends each queued item."""
+    commit = asyncio.ensure_future(db_call(flush, batch))
+    try:
+        # wait() neither raises the commit's error nor cancels it
+        await asyncio.wait([commit])
+    except asyncio.CancelledError:
+        # cancelled mid-commit (on_shutdown): the DB thread finishes the write anyway,
+        # so every dequeued future still gets its outcome before the writer stops
+        await asyncio.wait([commit])
+        _settle_batch(batch, commit)
+        raise
+    _settle_batch(batch, commit)
+
+
+async def batch_writer(q: asyncio.Queue, flush, window: float, limit: int):
+    """Group-commit loop shared by the submission and miss-reason queues."""
+    while True:
+        batch = [await q.get()]
+        try:
+            await asyncio.sleep(window)
+        except asyncio.CancelledError:
+            q.put_nowait(batch[0])  # on_shutdown flushes it
+            raise
+        await _commit_batch(flush, _drain_queue(q, batch, limit))
+
+
+# uid -> total submissions, for get_praise: counted once from the DB, then bumped on every insert
+_sub_counts: Dict[int, int] = {}
+
+
+def bump_sub_count(uid: int, n: int = 1):
+    # users not loaded yet are left out: their first get_praise counts them from the DB
+    if uid in _sub_counts:
+        _sub_counts[uid] += n
+
+
+async def add_submission_obj(user: types.User, submission: dict, message_id: int = None):
+    try:
+        fut = asyncio.get_running_loop().create_future()
+        submission_write_q.put_nowait(((user.id, user.username or "", user.first_name or ""),
+                                       _submission_params(user.id, submission, message_id), fut))
+        await fut
+        # the writer upserted exactly these values
+        cache_user(user.id, user.username or "", user.first_name or "")
+        bump_sub_count(user.id)
     except Exception:
         logger.exception("add_submission_obj error")
 
 
+def _write_submissions_bulk(db: sqlite3.Connection, rows: List[tuple]):
+    with db_transaction(db, "IMMEDIATE"):
+        db.executemany("INSERT OR IGNORE INTO users (id, username, first_name) VALUES (?, '', '')",
+                       [(uid,) for uid in {r[0] for r in rows}])
+        db.executemany(INSERT_SUBMISSION_SQL, [_submission_params(*r) for r in rows])
+
+
+async def add_submissions_bulk(rows: List[tuple]):
+    """Insert (user_id, submission, message_id) rows in one transaction with a single executemany.
+
+    Missing users get a bare record; existing user rows are left as they are.
+    """
+    if not rows:
+        return
+    try:
+        await db_call(_write_submissions_bulk, rows)
+        # existing user rows are untouched, so cached names stay valid
+        for uid in {r[0] for r in rows}:
+            bump_sub_count(uid, sum(1 for r in rows if r[0] == uid))
+    except Exception:
+        logger.exception("add_submissions_bulk error")
+
+
+# miss reasons are queued by handle_text and written in batches: one commit per burst of replies;
+# items are (uid, date, reason, future), the reply is sent once the future resolves
+reasons_write_q: "asyncio.Queue[tuple]" = asyncio.Queue()
+REASONS_BATCH_MAX = 200
+REASONS_BATCH_WINDOW = 0.05  # seconds to wait for more replies before flushing
+
+
+def _flush_reasons(db: sqlite3.Connection, batch: List[tuple]):
+    with db_transaction(db, "IMMEDIATE"):
+        db.executemany('INSERT OR REPLACE INTO miss_reasons (user_id, date, reason) VALUES (?, ?, ?)',
+                       [b[:3] for b in batch])
+
+
 # FILE SAVE
 async def download_file_bytes(file_id: str) -> Optional[bytes]:
     try:
@@ -308,25 +664,67 @@ async def download_file_bytes(file_id: str) -> Optional[bytes]:
         return None
 
 
-def save_conspect_files(user_id: str, section: str, topic_id: str, files: List[bytes], filenames: List[str]):
+def conspect_topic_dir(user_id: str, section: str, topic_id: str) -> str:
     base = os.path.join(CONSPECTS_DIR, str(user_id), f"{slugify_filename(section)}_{slugify_filename(topic_id)}")
     ensure_dir(base)
-    saved = []
-    for content, name in zip(files, filenames):
-        safe = slugify_filename(name)
-        path = os.path.join(base, safe)
-        try:
-            with open(path, "wb") as f:
-                f.write(content)
-            saved.append(path)
-        except Exception:
-            logger.exception("Failed to save file %s", path)
-    return saved
+    return base
+
+
+async def download_file_to(file_id: str, path: str) -> Optional[str]:
+    """Stream a Telegram file to path chunk by chunk (no full copy in memory); None on failure."""
+    try:
+        f = await bot.get_file(file_id)
+        with open(path, "wb") as dest:
+            await bot.download_file(f.file_path, destination=dest, seek=False)
+        return path
+    except Exception:
+        logger.exception("Failed to save file %s", path)
+        with suppress(OSError):
+            os.remove(path)
+        return None
+
+
+async def save_conspect_photos(user_id: str, section: str, topic_id: str, file_ids: List[str], filenames: List[str]):
+    """Download the photos concurrently straight into the topic folder; returns the saved paths."""
+    base = conspect_topic_dir(user_id, section, topic_id)
+    saved = await asyncio.gather(*(download_file_to(fid, os.path.join(base, slugify_filename(name)))
+                                   for fid, name in zip(file_ids, filenames)))
+    return [p for p in saved if p]
+
+
+# already-compressed media gains nothing from deflate, store it as-is
+ZIP_STORED_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".mp4")
+# what is left to deflate is mostly short conspect texts: fastest level, near-identical size
+ZIP_DEFLATE_LEVEL = 1
+
+
+def zip_compress_type(path: str) -> int:
+    return zipfile.ZIP_STORED if path.lower().endswith(ZIP_STORED_EXTENSIONS) else zipfile.ZIP_DEFLATED
+
+
+def iter_folder_files(path: str, prefix: str = ""):
+    """Yield (path, archive name) for all files under path, recursing with os.scandir.
+
+    Archive names are built up per directory level instead of a relpath() per file.
+    """
+    with os.scandir(path) as it:
+        for e in it:
+            if e.is_dir(follow_symlinks=False):
+                yield from iter_folder_files(e.path, f"{prefix}{e.name}/")
+            elif e.is_file():
+                yield e.path, prefix + e.name
+
+
+def build_folder_zip(folder: str, zip_path: str):
+    """Blocking: write every file under folder into a zip at zip_path (run it in a worker thread)."""
+    with zipfile.ZipFile(zip_path, "w", compresslevel=ZIP_DEFLATE_LEVEL) as zf:
+        for full, arc in iter_folder_files(folder):
+            zf.write(full, arc, compress_type=zip_compress_type(full))
 
 
 def save_conspect_text(user_id: str, section: str, topic_id: str, text: str):
-    base = os.path.join(CONSPECTS_DIR, str(user_id), f"{slugify_filename(section)}_{slugify_filename(topic_id)}")
-    ensure_dir(base)
+    """Blocking disk write: handlers call it through asyncio.to_thread."""
+    base = conspect_topic_dir(user_id, section, topic_id)
     fname = datetime.utcnow().strftime("%Y%m%d_%H%M%S") + ".txt"
     path = os.path.join(base, fname)
     try:
@@ -339,7 +737,7 @@ def save_conspect_text(user_id: str, section: str, topic_id: str, text: str):
 
 
 # ---------------- KEYBOARDS ----------------
-def make_main_kb(is_admin: bool):
+def _build_main_kb(is_admin: bool):
     kb = ReplyKeyboardMarkup(resize_keyboard=True)
     kb.add(KeyboardButton("📚 Сдать ДЗ"))
     kb.add(KeyboardButton("📘 Сдать конспект"))
@@ -350,14 +748,14 @@ def make_main_kb(is_admin: bool):
     return kb
 
 
-def section_keyboard():
+def _build_section_keyboard():
     kb = InlineKeyboardMarkup()
     for sec in SECTIONS.keys():
         kb.add(InlineKeyboardButton(sec, callback_data=f"sec|{sec}"))
     return kb
 
 
-def topics_keyboard(section_name):
+def _build_topics_keyboard(section_name):
     kb = InlineKeyboardMarkup(row_width=2)
     topics = SECTIONS.get(section_name, [])
     for t in topics:
@@ -367,7 +765,7 @@ def topics_keyboard(section_name):
     return kb
 
 
-def admin_kb():
+def _build_admin_kb():
     kb = InlineKeyboardMarkup()
     kb.add(InlineKeyboardButton("📋 Дневной отчёт (подробный)", callback_data="admin|daily_full"))
     kb.add(InlineKeyboardButton("🆕 Создать таблицу (сохранить)", callback_data="admin|new_report"))
@@ -382,6 +780,34 @@ def admin_kb():
     return kb
 
 
+# keyboards depend only on static data, so build them once and hand out the same markup
+_MAIN_KBS = {flag: _build_main_kb(flag) for flag in (False, True)}
+_SECTION_KB = _build_section_keyboard()
+_TOPIC_KBS = {name: _build_topics_keyboard(name) for name in SECTIONS}
+_ADMIN_KB = _build_admin_kb()
+
+
+def make_main_kb(is_admin: bool):
+    return _MAIN_KBS[bool(is_admin)]
+
+
+def main_kb_for(user_id: int):
+    return _MAIN_KBS[user_id == ADMIN_ID]
+
+
+def section_keyboard():
+    return _SECTION_KB
+
+
+def topics_keyboard(section_name):
+    kb = _TOPIC_KBS.get(section_name)
+    return kb if kb is not None else _build_topics_keyboard(section_name)
+
+
+def admin_kb():
+    return _ADMIN_KB
+
+
 # PRAISE
 generic_praise = ["Молодец, отличная работа!", "Здорово, так держать!", "Круто, ты справился!", "Умница, ДЗ принято!","АЙ ЛЕВ","Лёва оценил!!!","Ты - будущий 100-балльник"]
 context_praise_templates = ["Отлично поработал над «{topic}» — заметен прогресс!",
@@ -391,87 +817,96 @@ photo_praise = ["Фото принято — выглядит аккуратно
                 "Фото получено — спасибо за старание!", "Имба, Леве понравится!" , "Ну ты прям машина!!"]
 
 
-def get_praise(user_id: int, section: str, topic_title: str, content_type: str) -> str:
-    try:
-        cursor.execute('SELECT COUNT(*) FROM submissions WHERE user_id = ?', (user_id,))
-        total_subs = cursor.fetchone()[0]
-    except Exception:
-        total_subs = 0
+async def user_submission_count(user_id: int) -> int:
+    total_subs = _sub_counts.get(user_id)
+    if total_subs is None:
+        try:
+            total_subs = (await db_fetchone('SELECT COUNT(*) FROM submissions WHERE user_id = ?', (user_id,)))[0]
+            _sub_counts[user_id] = total_subs
+        except Exception:
+            total_subs = 0
+    return total_subs
+
+
+async def get_praise(user_id: int, section: str, topic_title: str, content_type: str) -> str:
+    # the reply keeps one or two phrases: pick that first and only build the phrases that are kept
+    n = 2 if random.random() > 0.4 else 1
     messages = []
     if topic_title:
         messages.append(random.choice(context_praise_templates).format(topic=topic_title))
-    if content_type == "photo":
-        messages.append(random.choice(photo_praise))
-    else:
-        messages.append(random.choice(generic_praise))
-    if total_subs >= 10:
-        messages.append("Ты постоянный участник — это впечатляет! 🔥")
-    elif total_subs >= 3:
-        messages.append("Отлично, ты активно сдаёшь. Продолжай!")
-    n = 2 if random.random() > 0.4 else 1
-    return " ".join(messages[:n])
+    if len(messages) < n:
+        messages.append(random.choice(photo_praise if content_type == "photo" else generic_praise))
+    if len(messages) < n:
+        total_subs = await user_submission_count(user_id)
+        if total_subs >= 10:
+            messages.append("Ты постоянный участник — это впечатляет! 🔥")
+        elif total_subs >= 3:
+            messages.append("Отлично, ты активно сдаёшь. Продолжай!")
+    return " ".join(messages)
 
 
 # MAKING EXCEL
-def style_worksheet(ws):
-    header_fill = PatternFill(start_color="A7F3D0", end_color="A7F3D0", fill_type="solid")
-    thin = Side(border_style="thin", color="000000")
-    border = Border(left=thin, right=thin, top=thin, bottom=thin)
-
-    # header row styling
-    for cell in ws[1]:
-        cell.fill = header_fill
-        cell.font = Font(bold=True)
-        cell.border = border
-        cell.alignment = Alignment(horizontal="center", vertical="center")
-
-    # apply border to body and compute column widths
-    for row in ws.iter_rows(min_row=2):
-        for cell in row:
-            cell.border = border
-            cell.alignment = Alignment(wrap_text=True, vertical="top")
-
-    # auto width
-    for i, col in enumerate(ws.columns, 1):
-        max_length = 0
-        col_letter = get_column_letter(i)
-        for cell in col:
-            try:
-                if cell.value is not None:
-                    length = len(str(cell.value))
-                    if length > max_length:
-                        max_length = length
-            except Exception:
-                pass
-        ws.column_dimensions[col_letter].width = min(max_length + 5, 60)
-
-
-def submissions_for_date(target_date: date) -> List[dict]:
+# shared style objects: cells reference them instead of building new ones per cell
+_THIN_SIDE = Side(border_style="thin", color="000000")
+REPORT_BORDER = Border(left=_THIN_SIDE, right=_THIN_SIDE, top=_THIN_SIDE, bottom=_THIN_SIDE)
+REPORT_HEADER_FILL = PatternFill(start_color="A7F3D0", end_color="A7F3D0", fill_type="solid")
+REPORT_HEADER_FONT = Font(bold=True)
+REPORT_HEADER_ALIGNMENT = Alignment(horizontal="center", vertical="center")
+REPORT_BODY_ALIGNMENT = Alignment(wrap_text=True, vertical="top")
+REPORT_LINK_FONT = Font(color="0563C1", underline="single")
+
+# named styles for generated reports: each cell points at one of these by name
+REPORT_STYLE_HEADER = "report_header"
+REPORT_STYLE_BODY = "report_body"
+REPORT_STYLE_LINK = "report_link"
+
+
+def add_report_styles(wb):
+    """Register the report named styles on a new workbook."""
+    wb.add_named_style(NamedStyle(name=REPORT_STYLE_HEADER, font=REPORT_HEADER_FONT, fill=REPORT_HEADER_FILL,
+                                  border=REPORT_BORDER, alignment=REPORT_HEADER_ALIGNMENT))
+    wb.add_named_style(NamedStyle(name=REPORT_STYLE_BODY, border=REPORT_BORDER, alignment=REPORT_BODY_ALIGNMENT))
+    wb.add_named_style(NamedStyle(name=REPORT_STYLE_LINK, font=REPORT_LINK_FONT, border=REPORT_BORDER,
+                                  alignment=REPORT_BODY_ALIGNMENT))
+
+
+# one row per user: submitted types, miss reason and the latest submission of the day
+DAILY_SUMMARY_SQL = '''
+    WITH day AS (
+        SELECT user_id, type, topic_id, topic_title, message_id,
+               ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY ts DESC) AS rn
+        FROM submissions
+        WHERE date = ?
+    )
+    SELECT u.id, u.username, u.first_name,
+           GROUP_CONCAT(DISTINCT d.type),
+           mr.reason,
+           MAX(CASE WHEN d.rn = 1 THEN d.topic_id END),
+           MAX(CASE WHEN d.rn = 1 THEN d.topic_title END),
+           MAX(CASE WHEN d.rn = 1 THEN d.message_id END)
+    FROM users u
+    LEFT JOIN day d ON d.user_id = u.id
+    LEFT JOIN miss_reasons mr ON mr.user_id = u.id AND mr.date = ?
+    GROUP BY u.id
+    ORDER BY u.id
+'''
+
+
+def submissions_for_date(target_date: date, db: sqlite3.Connection) -> List[dict]:
     """Build summary rows including a task_flag (topic_id) and a mention link fallback."""
     dstr = target_date.isoformat()
     try:
-        cursor.execute('SELECT id, username, first_name FROM users ORDER BY id')
-        users = cursor.fetchall()
+        summary = db.execute(DAILY_SUMMARY_SQL, (dstr, dstr)).fetchall()
         result = []
-        for u in users:
-            uid, uname, fname = u
+        for uid, uname, fname, types_csv, reason, topic_id, topic_title, message_id in summary:
             display_name = uname or fname or ""
-            # compute types submitted
-            cursor.execute('SELECT type FROM submissions WHERE user_id = ? AND date = ?', (uid, dstr))
-            types = {r[0] for r in cursor.fetchall()}
+            types = set(types_csv.split(",")) if types_csv else set()
             dz = 'dz' in types
             cons = 'conspect' in types
-            # miss reason
-            cursor.execute('SELECT reason FROM miss_reasons WHERE user_id = ? AND date = ?', (uid, dstr))
-            rr = cursor.fetchone()
-            reason = rr[0] if rr else ""
+            reason = reason if reason is not None else ""
             # last submission topic (task flag) for that day
-            cursor.execute(
-                'SELECT topic_id, topic_title, message_id FROM submissions WHERE user_id = ? AND date = ? ORDER BY ts DESC LIMIT 1',
-                (uid, dstr))
-            trow = cursor.fetchone()
-            task_flag = trow[0] if trow and trow[0] else (trow[1] if trow and trow[1] else "")
-            message_id = trow[2] if trow and len(trow) > 2 and trow[2] else None
+            task_flag = topic_id or topic_title or ""
+            message_id = message_id or None
             result.append({
                 "user_id": uid,
                 "username": display_name,
@@ -488,158 +923,122 @@ def submissions_for_date(target_date: date) -> List[dict]:
         return []
 
 
-def make_daily_excel(target_date: date) -> io.BytesIO:
-    rows = submissions_for_date(target_date)
-    df_summary = pd.DataFrame(rows)
-    try:
-        cursor.execute(
-            "SELECT s.user_id, u.username, u.first_name, s.type, s.section, s.topic_id, s.topic_title, s.content_type, s.content_summary, s.photo_file_id, s.date, s.ts "
-            "FROM submissions s JOIN users u ON s.user_id = u.id "
-            "WHERE s.date = ? "
-            "ORDER BY s.ts",
-            (target_date.isoformat(),)
-        )
-        raw = cursor.fetchall()
-        raw_rows = [{
-            "user_id": r[0],
-            "username": r[1] or r[2] or "",
-            "type": r[3],
-            "section": r[4],
-            "topic_id": r[5],
-            "topic_title": r[6],
-            "content_type": r[7],
-            "content_summary": r[8],
-            "photo_file_id": r[9],
-            "date": r[10],
-            "ts": r[11]
-        } for r in raw]
-        df_raw = pd.DataFrame(raw_rows)
-    except Exception:
-        logger.exception("make_daily_excel raw fetch error")
-        df_raw = pd.DataFrame(
-            columns=["user_id", "username", "type", "section", "topic_id", "topic_title", "content_type",
-                     "content_summary", "photo_file_id", "date", "ts"])
-
-    # ensure task_flag exists in summary (comes from submissions_for_date)
-    if "task_flag" not in df_summary.columns:
-        df_summary["task_flag"] = ""
-
-    # ensure task_flag in raw (from topic_id)
-    if "task_flag" not in df_raw.columns:
-        df_raw["task_flag"] = df_raw.get("topic_id", "")
-
-    # write initial excel to BytesIO
-    bio = io.BytesIO()
-    with pd.ExcelWriter(bio, engine="openpyxl") as writer:
-        df_summary.to_excel(writer, sheet_name="daily_summary", index=False)
-        df_raw.to_excel(writer, sheet_name="raw_submissions", index=False)
-    bio.seek(0)
-
-    # post-process with openpyxl to create hyperlinks and style
-    wb = load_workbook(filename=io.BytesIO(bio.read()))
-
-    # helper to make display name
-    def _display_name(username, first_name, uid):
-        if username and str(username).strip():
-            return f"@{username}"
-        if first_name and str(first_name).strip():
-            return first_name
-        return f"user_{uid}"
-
-    # process daily_summary sheet
-    if "daily_summary" in wb.sheetnames:
-        ws = wb["daily_summary"]
-        # map headers
-        headers = {cell.value: idx + 1 for idx, cell in enumerate(ws[1])}
-        uid_col = headers.get("user_id")
-        uname_col = headers.get("username")
-        task_col = headers.get("task_flag")
-        if uid_col and uname_col:
-            for row in range(2, ws.max_row + 1):
-                uid_cell = ws.cell(row=row, column=uid_col)
-                uname_cell = ws.cell(row=row, column=uname_col)
-                try:
-                    uid_val = int(uid_cell.value)
-                except Exception:
-                    uid_val = None
-                if uid_val:
-                    try:
-                        cursor.execute('SELECT username, first_name FROM users WHERE id = ?', (int(uid_val),))
-                        r = cursor.fetchone()
-                        uname_db = r[0] if r else None
-                        fname_db = r[1] if r else None
-                    except Exception:
-                        uname_db = None
-                        fname_db = None
-                    final_display = _display_name(uname_db, fname_db, uid_val)
-                    uname_cell.value = final_display
-                    uname_cell.hyperlink = f"tg://user?id={uid_val}"
-                    uname_cell.style = "Hyperlink"
-        style_worksheet(ws)
-
-    # process raw_submissions sheet
-    if "raw_submissions" in wb.sheetnames:
-        ws2 = wb["raw_submissions"]
-        headers2 = {cell.value: idx + 1 for idx, cell in enumerate(ws2[1])}
-        uid_col2 = headers2.get("user_id")
-        uname_col2 = headers2.get("username")
-        topic_id_col = headers2.get("topic_id")
-        task_col2 = headers2.get("task_flag")
-        if uid_col2 and uname_col2:
-            for row in range(2, ws2.max_row + 1):
-                uid_cell = ws2.cell(row=row, column=uid_col2)
-                uname_cell = ws2.cell(row=row, column=uname_col2)
-                try:
-                    uid_val = int(uid_cell.value)
-                except Exception:
-                    uid_val = None
-                if uid_val:
-                    try:
-                        cursor.execute('SELECT username, first_name FROM users WHERE id = ?', (int(uid_val),))
-                        r = cursor.fetchone()
-                        uname_db = r[0] if r else None
-                        fname_db = r[1] if r else None
-                    except Exception:
-                        uname_db = None
-                        fname_db = None
-                    final_display = _display_name(uname_db, fname_db, uid_val)
-                    uname_cell.value = final_display
-                    uname_cell.hyperlink = f"tg://user?id={uid_val}"
-                    uname_cell.style = "Hyperlink"
-        # ensure task_flag column exists and filled from topic_id
-        if topic_id_col:
-            if not task_col2:
-                task_col_idx = ws2.max_column + 1
-                ws2.cell(row=1, column=task_col_idx, value="task_flag")
-            else:
-                task_col_idx = task_col2
-            for row in range(2, ws2.max_row + 1):
-                topic_cell = ws2.cell(row=row, column=topic_id_col)
-                val = topic_cell.value or ""
-                ws2.cell(row=row, column=task_col_idx, value=val)
-        style_worksheet(ws2)
-
-    # save workbook to BytesIO and also save a copy on disk
-    out = io.BytesIO()
-    wb.save(out)
-    out.seek(0)
-
-    # save on disk
+DAILY_SUMMARY_HEADERS = ["user_id", "username", "date", "dz_submitted", "conspect_submitted", "miss_reason",
+                         "task_flag", "message_id"]
+RAW_SUBMISSION_HEADERS = ["user_id", "username", "type", "section", "topic_id", "topic_title", "content_type",
+                          "content_summary", "photo_file_id", "date", "ts", "task_flag"]
+
+
+def _header_cells(ws, headers: List[str]) -> list:
+    cells = []
+    for h in headers:
+        cell = WriteOnlyCell(ws, value=h)
+        cell.style = REPORT_STYLE_HEADER
+        cells.append(cell)
+    return cells
+
+
+def _body_cell(ws, value, hyperlink: str = None) -> WriteOnlyCell:
+    cell = WriteOnlyCell(ws, value=value)
+    if hyperlink:
+        cell.hyperlink = hyperlink
+        cell.style = REPORT_STYLE_LINK
+    else:
+        cell.style = REPORT_STYLE_BODY
+    return cell
+
+
+def _set_column_widths(ws, headers: List[str], rows: List[list]):
+    # write-only sheets need widths before the first row is appended
+    for i, h in enumerate(headers):
+        max_length = len(h)
+        for r in rows:
+            v = r[i]
+            if v is not None and v != "":
+                max_length = max(max_length, len(str(v)))
+        ws.column_dimensions[get_column_letter(i + 1)].width = min(max_length + 5, 60)
+
+
+def _display_name(username, first_name, uid):
+    if username and str(username).strip():
+        return f"@{username}"
+    if first_name and str(first_name).strip():
+        return first_name
+    return f"user_{uid}"
+
+
+def _write_user_sheet(wb, title: str, headers: List[str], rows: List[tuple], user_cache: Dict[int, tuple]):
+    """Append a styled sheet from rows ordered like headers.
+
+    The username column shows the display name and links to the user.
+    """
+    ws = wb.create_sheet(title)
+    uid_idx = headers.index("user_id")
+    uname_idx = headers.index("username")
+    values_rows = []
+    links = []
+    for r in rows:
+        values = list(r)
+        link = None
+        uid_val = values[uid_idx]
+        if uid_val:
+            uname_db, fname_db = user_cache.get(int(uid_val), (None, None))
+            values[uname_idx] = _display_name(uname_db, fname_db, uid_val)
+            link = f"tg://user?id={uid_val}"
+        values_rows.append(values)
+        links.append(link)
+    _set_column_widths(ws, headers, values_rows)
+    ws.append(_header_cells(ws, headers))
+    for values, link in zip(values_rows, links):
+        ws.append([_body_cell(ws, v, link if ci == uname_idx else None) for ci, v in enumerate(values)])
+    return ws
+
+
+def make_daily_excel(target_date: date) -> str:
+    """Blocking: build the daily workbook under REPORTS_DIR and return its path.
+
+    Call it via asyncio.to_thread, it reads through thread_db().
+    """
+    db = thread_db()
+    # summary and raw rows come from one read transaction, so both sheets see the same snapshot
+    with db_transaction(db):
+        names = load_user_names(db)
+        rows = submissions_for_date(target_date, db)
+        try:
+            raw = db.execute(
+                "SELECT s.user_id, u.username, u.first_name, s.type, s.section, s.topic_id, s.topic_title, s.content_type, s.content_summary, s.photo_file_id, s.date, s.ts "
+                "FROM submissions s JOIN users u ON s.user_id = u.id "
+                "WHERE s.date = ? "
+                "ORDER BY s.ts",
+                (target_date.isoformat(),)
+            ).fetchall()
+        except Exception:
+            logger.exception("make_daily_excel raw fetch error")
+            raw = []
+    # rows go to the sheet in RAW_SUBMISSION_HEADERS order; task_flag mirrors topic_id
+    raw_rows = [(r[0], r[1] or r[2] or "", *r[3:12], r[5] or "") for r in raw]
+    summary_rows = [[r.get(h) for h in DAILY_SUMMARY_HEADERS] for r in rows]
+
+    # single write-only pass: rows are streamed with shared styles and inline hyperlinks
+    wb = Workbook(write_only=True)
+    add_report_styles(wb)
+    _write_user_sheet(wb, "daily_summary", DAILY_SUMMARY_HEADERS, summary_rows, names)
+    _write_user_sheet(wb, "raw_submissions", RAW_SUBMISSION_HEADERS, raw_rows, names)
+
+    # serialize once, straight to the report file; senders upload it from disk
     fname = f"daily_report_{target_date.isoformat()}_{int(time.time())}.xlsx"
     fpath = os.path.join(REPORTS_DIR, fname)
-    with open(fpath, "wb") as f:
-        f.write(out.getbuffer())
+    wb.save(fpath)
     logger.info(f"Saved report to {fpath}")
-
-    out.seek(0)
-    return out
+    return fpath
 
 
 async def send_daily_excel_to_admin(target_date: date):
     try:
-        bio = make_daily_excel(target_date)
+        fpath = await asyncio.to_thread(make_daily_excel, target_date)
         fname = f"daily_report_{target_date.isoformat()}.xlsx"
-        await bot.send_document(ADMIN_ID, InputFile(bio, filename=fname))
+        with open(fpath, "rb") as f:
+            await bot.send_document(ADMIN_ID, InputFile(f, filename=fname))
         await bot.send_message(ADMIN_ID, f"Отчёт за {target_date.isoformat()} отправлен.")
     except Exception:
         logger.exception("send_daily_excel_to_admin error")
@@ -652,7 +1051,7 @@ async def send_daily_excel_to_admin(target_date: date):
 # HANDLERS
 @dp.message_handler(commands=["start", "menu"])
 async def cmd_start(message: types.Message):
-    ensure_user_record_obj(message.from_user)
+    await ensure_user_record_obj(message.from_user)
     is_admin = (message.from_user.id == ADMIN_ID)
     await message.answer("Привет! Я бот для сдачи ДЗ и конспектов.\nВыбери действие:",
                          reply_markup=make_main_kb(is_admin))
@@ -676,17 +1075,17 @@ async def cmd_my_conspects(message: types.Message):
     folder = os.path.join(CONSPECTS_DIR, uid)
     if not os.path.exists(folder):
         return await message.answer("У тебя пока нет сохранённых конспектов.",
-                                    reply_markup=make_main_kb(message.from_user.id == ADMIN_ID))
-    buf = io.BytesIO()
-    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-        for root, _, files in os.walk(folder):
-            for f in files:
-                full = os.path.join(root, f)
-                arc = os.path.relpath(full, folder)
-                zf.write(full, arc)
-    buf.seek(0)
-    await bot.send_document(message.chat.id, InputFile(buf, filename="my_conspects.zip"),
-                            reply_markup=make_main_kb(message.from_user.id == ADMIN_ID))
+                                    reply_markup=main_kb_for(message.from_user.id))
+    # zip on disk in a worker thread: the archive never sits in RAM and the event loop keeps running
+    fd, zip_path = tempfile.mkstemp(suffix=".zip")
+    os.close(fd)
+    try:
+        await asyncio.to_thread(build_folder_zip, folder, zip_path)
+        with open(zip_path, "rb") as zf:
+            await bot.send_document(message.chat.id, InputFile(zf, filename="my_conspects.zip"),
+                                    reply_markup=main_kb_for(message.from_user.id))
+    finally:
+        os.remove(zip_path)
 
 
 @dp.message_handler(lambda m: m.text == "📌 Главное меню")
@@ -724,11 +1123,7 @@ async def cb_topic_choose(call: types.CallbackQuery):
     if uid not in pending or "section" not in pending[uid]:
         await call.answer("Нет активного действия. Сначала нажми 'Сдать ДЗ' или 'Сдать конспект'.", show_alert=True)
         return
-    topic = None
-    for t in SECTIONS.get(section, []):
-        if t["id"] == topic_id:
-            topic = t
-            break
+    topic = TOPIC_INDEX.get((section, topic_id))
     if not topic:
         await call.answer("Тема не найдена.", show_alert=True)
         return
@@ -748,13 +1143,14 @@ async def cb_cancel(call: types.CallbackQuery):
     pending.pop(uid, None)
     admin_pending.pop(uid, None)
     await bot.send_message(call.from_user.id, "Операция отменена.",
-                           reply_markup=make_main_kb(call.from_user.id == ADMIN_ID))
+                           reply_markup=main_kb_for(call.from_user.id))
     await call.answer()
 
 
 @dp.message_handler(content_types=types.ContentType.TEXT)
 async def handle_text(message: types.Message):
-    uid = str(message.from_user.id)
+    uid_i = message.from_user.id
+    uid = str(uid_i)
     text = message.text.strip()
 
     if message.text in ("📊 Статистика",):
@@ -765,18 +1161,21 @@ async def handle_text(message: types.Message):
 
     if uid in reasons_pending:
         miss_date = reasons_pending.pop(uid)
+        fut = asyncio.get_running_loop().create_future()
+        reasons_write_q.put_nowait((uid_i, miss_date, text, fut))
         try:
-            cursor.execute('INSERT OR REPLACE INTO miss_reasons (user_id, date, reason) VALUES (?, ?, ?)',
-                           (int(uid), miss_date, text))
-            conn.commit()
+            await fut
         except Exception:
             logger.exception("saving miss reason failed")
+            reasons_pending[uid] = miss_date  # the next reply is taken as the reason again
+            return await message.answer("Не удалось сохранить причину пропуска, отправь её ещё раз.",
+                                        reply_markup=main_kb_for(uid_i))
         await message.answer(f"Спасибо — причина пропуска за {miss_date} сохранена.",
-                             reply_markup=make_main_kb(message.from_user.id == ADMIN_ID))
+                             reply_markup=main_kb_for(uid_i))
         return
 
     # admin flows waiting for text
-    if str(message.from_user.id) in admin_pending:
+    if uid in admin_pending:
         # handled by admin_pending_text callback
         return
 
@@ -786,56 +1185,43 @@ async def handle_text(message: types.Message):
                "topic_title": p["topic"]["title"],
                "content_type": "text", "content_summary": (text if len(text) <= 300 else text[:297] + "..."),
                "date": today_str(), "ts": datetime.utcnow().isoformat()}
-        add_submission_obj(message.from_user, sub, message.message_id)
+        await add_submission_obj(message.from_user, sub, message.message_id)
         if sub["type"] == "conspect":
             try:
-                save_conspect_text(uid, sub["section"].replace("/", "_"), sub["topic_id"], text)
+                await asyncio.to_thread(save_conspect_text, uid, sub["section"].replace("/", "_"), sub["topic_id"], text)
             except Exception:
                 logger.exception("Failed to save conspect text")
-        praise = get_praise(message.from_user.id, sub["section"], sub["topic_title"], "text")
-        await message.answer(praise, reply_markup=make_main_kb(message.from_user.id == ADMIN_ID))
-        try:
-            # Обновляем данные пользователя перед отправкой уведомления админу
-            await ensure_user_with_current_data(message.from_user.id)
-            await bot.send_message(ADMIN_ID,
-                                   f"✅ {mention_html_by_id(message.from_user.id)} прислал {sub['type'].upper()}: {sub['section']} — {sub['topic_title']}\n{sub['content_summary']}",
-                                   parse_mode="HTML")
-        except Exception:
-            pass
+        praise = await get_praise(uid_i, sub["section"], sub["topic_title"], "text")
+        await message.answer(praise, reply_markup=main_kb_for(uid_i))
+        spawn(notify_admin(uid_i, "✅", f"прислал {sub['type'].upper()}: {sub['section']} — {sub['topic_title']}\n{sub['content_summary']}"))
         return
 
     low = text.lower()
-    if low.startswith("дз") or low.startswith("конспект"):
+    if low.startswith(KIND_PREFIXES):
         kind = "dz" if low.startswith("дз") else "conspect"
         sub = {"type": kind, "section": "Без раздела", "topic_id": "none", "topic_title": text.split("\n", 1)[0][:50],
                "content_type": "text", "content_summary": (text if len(text) <= 300 else text[:297] + "..."),
                "date": today_str(), "ts": datetime.utcnow().isoformat()}
-        add_submission_obj(message.from_user, sub, message.message_id)
+        await add_submission_obj(message.from_user, sub, message.message_id)
         if kind == "conspect":
             try:
-                save_conspect_text(uid, "Без_раздела", "none", text)
+                await asyncio.to_thread(save_conspect_text, uid, "Без_раздела", "none", text)
             except Exception:
                 logger.exception("Failed to save conspect text")
-        praise = get_praise(message.from_user.id, sub["section"], sub["topic_title"], "text")
+        praise = await get_praise(uid_i, sub["section"], sub["topic_title"], "text")
         await message.answer("Записал без выбора темы. В следующий раз выбери тему через меню.\n\n" + praise,
-                             reply_markup=make_main_kb(message.from_user.id == ADMIN_ID))
-        try:
-            # Обновляем данные пользователя перед отправкой уведомления админу
-            await ensure_user_with_current_data(message.from_user.id)
-            await bot.send_message(ADMIN_ID,
-                                   f"✅ {mention_html_by_id(message.from_user.id)} прислал {sub['type'].upper()} (без темы): {sub['content_summary']}",
-                                   parse_mode="HTML")
-        except Exception:
-            pass
+                             reply_markup=main_kb_for(uid_i))
+        spawn(notify_admin(uid_i, "✅", f"прислал {sub['type'].upper()} (без темы): {sub['content_summary']}"))
         return
 
     await message.answer("Чтобы сдать ДЗ или конспект: нажми соответствующую кнопку в меню и выбери тему.",
-                         reply_markup=make_main_kb(message.from_user.id == ADMIN_ID))
+                         reply_markup=main_kb_for(uid_i))
 
 
 @dp.message_handler(content_types=types.ContentType.PHOTO)
 async def handle_photo(message: types.Message):
-    uid = str(message.from_user.id)
+    uid_i = message.from_user.id
+    uid = str(uid_i)
     caption = message.caption or ""
     mgid = getattr(message, "media_group_id", None)
 
@@ -851,8 +1237,9 @@ async def handle_photo(message: types.Message):
             if caption:
                 entry["caption"] = caption
             entry["last_update"] = time.time()
+        schedule_media_group_finalize(key)
         await message.answer("Фото получено — обрабатываю альбом...",
-                             reply_markup=make_main_kb(message.from_user.id == ADMIN_ID))
+                             reply_markup=main_kb_for(uid_i))
         return
 
     # single photo
@@ -860,133 +1247,185 @@ async def handle_photo(message: types.Message):
         p = pending.pop(uid)
         file_id = message.photo[-1].file_id
         summary = (caption[:200] + "...") if len(caption) > 200 else caption or "Фото"
+        now = datetime.utcnow()  # one clock read for ts and the saved file name
         sub = {"type": p["type"], "section": p["section"], "topic_id": p["topic"]["id"],
                "topic_title": p["topic"]["title"],
                "content_type": "photo", "content_summary": summary, "photo_file_id": file_id, "date": today_str(),
-               "ts": datetime.utcnow().isoformat()}
-        add_submission_obj(message.from_user, sub, message.message_id)
+               "ts": now.isoformat()}
+        await add_submission_obj(message.from_user, sub, message.message_id)
         if sub["type"] == "conspect":
             try:
-                fbytes = await download_file_bytes(file_id)
-                if fbytes:
-                    save_conspect_files(uid, sub["section"].replace("/", "_"), sub["topic_id"], [fbytes],
-                                        [f"photo_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.jpg"])
+                await save_conspect_photos(uid, sub["section"].replace("/", "_"), sub["topic_id"], [file_id],
+                                           [f"photo_{now.strftime('%Y%m%d_%H%M%S')}.jpg"])
             except Exception:
                 logger.exception("Failed to save conspect photo")
-        praise = get_praise(message.from_user.id, sub["section"], sub["topic_title"], "photo")
-        await message.answer(praise, reply_markup=make_main_kb(message.from_user.id == ADMIN_ID))
-        try:
-            # Обновляем данные пользователя перед отправкой уведомления админу
-            await ensure_user_with_current_data(message.from_user.id)
-            await bot.send_message(ADMIN_ID,
-                                   f"📸 {mention_html_by_id(message.from_user.id)} прислал {sub['type'].upper()}: {sub['section']} — {sub['topic_title']} — {summary}",
-                                   parse_mode="HTML")
-            await bot.forward_message(ADMIN_ID, message.chat.id, message.message_id)
-        except Exception:
-            pass
+        praise = await get_praise(uid_i, sub["section"], sub["topic_title"], "photo")
+        await message.answer(praise, reply_markup=main_kb_for(uid_i))
+        spawn(notify_admin(uid_i, "📸", f"прислал {sub['type'].upper()}: {sub['section']} — {sub['topic_title']} — {summary}",
+                           forward=message))
         return
 
     # caption-start fallback
-    if caption.lower().startswith("дз") or caption.lower().startswith("конспект"):
-        kind = "dz" if caption.lower().startswith("дз") else "conspect"
+    clow = caption.lower()
+    if clow.startswith(KIND_PREFIXES):
+        kind = "dz" if clow.startswith("дз") else "conspect"
         file_id = message.photo[-1].file_id
         summary = (caption[:200] + "...") if len(caption) > 200 else caption
+        now = datetime.utcnow()
         sub = {"type": kind, "section": "Без раздела", "topic_id": "none",
                "topic_title": summary.split("\n", 1)[0][:50],
                "content_type": "photo", "content_summary": summary, "photo_file_id": file_id, "date": today_str(),
-               "ts": datetime.utcnow().isoformat()}
-        add_submission_obj(message.from_user, sub, message.message_id)
+               "ts": now.isoformat()}
+        await add_submission_obj(message.from_user, sub, message.message_id)
         if kind == "conspect":
             try:
-                fbytes = await download_file_bytes(file_id)
-                if fbytes:
-                    save_conspect_files(uid, "Без_раздела", "none", [fbytes],
-                                        [f"photo_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.jpg"])
+                await save_conspect_photos(uid, "Без_раздела", "none", [file_id],
+                                           [f"photo_{now.strftime('%Y%m%d_%H%M%S')}.jpg"])
             except Exception:
                 logger.exception("Failed to save conspect photo")
-        praise = get_praise(message.from_user.id, sub["section"], sub["topic_title"], "photo")
+        praise = await get_praise(uid_i, sub["section"], sub["topic_title"], "photo")
         await message.answer("Принял (без выбора темы). " + praise,
-                             reply_markup=make_main_kb(message.from_user.id == ADMIN_ID))
-        try:
-            # Обновляем данные пользователя перед отправкой уведомления админу
-            await ensure_user_with_current_data(message.from_user.id)
-            await bot.forward_message(ADMIN_ID, message.chat.id, message.message_id)
-        except Exception:
-            pass
+                             reply_markup=main_kb_for(uid_i))
+        spawn(notify_admin(uid_i, forward=message))
         return
 
     await message.answer("Чтобы сдать ДЗ: сначала нажми кнопку в меню, выбери тему, затем отправь фото.",
-                         reply_markup=make_main_kb(message.from_user.id == ADMIN_ID))
+                         reply_markup=main_kb_for(uid_i))
 
 
-# media-groups finalizer (runs periodically)
-async def process_media_groups():
-    now = time.time()
-    keys = list(media_groups.keys())
-    for key in keys:
-        entry = media_groups.get(key)
-        if not entry:
-            continue
-        if now - entry['last_update'] > 1.5:
-            try:
-                uid = entry.get("uid")
-                p_snapshot = entry.get("pending_snapshot") or {}
-                p_type = p_snapshot.get("type", "dz")
-                section = p_snapshot.get("section", "Без раздела")
-                topic = p_snapshot.get("topic", {"id": "none", "title": "Альбом"})
-                file_ids = entry.get("file_ids", [])
-                caption = entry.get("caption", "") or f"Альбом из {len(file_ids)} фото"
-                sub = {"type": p_type, "section": section, "topic_id": topic.get("id"),
-                       "topic_title": topic.get("title"),
-                       "content_type": "photo_album", "content_summary": caption, "photo_file_id": ";".join(file_ids),
-                       "date": today_str(), "ts": datetime.utcnow().isoformat()}
-                ensure_user_record_by_id(int(uid))
-                fake_user = types.User(id=int(uid), is_bot=False, first_name="", username="")
-                add_submission_obj(fake_user, sub, None)
-                # save files if conspect
-                if sub['type'] == 'conspect':
-                    files = []
-                    names = []
-                    for idx, fid in enumerate(file_ids, start=1):
-                        b = await download_file_bytes(fid)
-                        if b:
-                            name = f"photo_{idx}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.jpg"
-                            files.append(b);
-                            names.append(name)
-                    if files:
-                        save_conspect_files(uid, section.replace("/", "_"), sub['topic_id'], files, names)
-                try:
-                    await bot.send_message(int(uid), get_praise(int(uid), sub['section'], sub['topic_title'], 'photo'))
-                except Exception:
-                    pass
-                try:
-                    # Обновляем данные пользователя перед отправкой уведомления админу
-                    await ensure_user_with_current_data(int(uid))
-                    await bot.send_message(ADMIN_ID,
-                                           f"📸 {mention_html_by_id(int(uid))} прислал {sub['type'].upper()} (альбом): {sub['section']} — {sub['topic_title']}",
-                                           parse_mode="HTML")
-                except Exception:
-                    pass
-            except Exception:
-                logger.exception('Error finalizing media group %s', key)
-            finally:
-                media_groups.pop(key, None)
+# media-groups finalizer: one debounced task per album
+# album photos arrive as separate updates; an album is finalized once no new photo came for this long
+MEDIA_GROUP_SETTLE = 1.5
+
+
+def schedule_media_group_finalize(key: str):
+    """(Re)start the one-shot finalize timer of a media group on every new photo.
+
+    spawn() keeps the task referenced; the entry holds it only so the next photo can cancel it.
+    """
+    entry = media_groups[key]
+    task = entry.get("finalize_task")
+    if task:
+        task.cancel()
+    entry["finalize_task"] = spawn(_finalize_media_group_later(key))
+
+
+async def _finalize_media_group_later(key: str):
+    await asyncio.sleep(MEDIA_GROUP_SETTLE)
+    # popped before any await, so a late photo of the same album can no longer cancel this task
+    entry = media_groups.pop(key, None)
+    if entry:
+        await finalize_media_group(key, entry)
+
+
+async def finalize_media_group(key: str, entry: Dict[str, Any]):
+    try:
+        uid = entry.get("uid")
+        p_snapshot = entry.get("pending_snapshot") or {}
+        p_type = p_snapshot.get("type", "dz")
+        section = p_snapshot.get("section", "Без раздела")
+        topic = p_snapshot.get("topic", {"id": "none", "title": "Альбом"})
+        file_ids = entry.get("file_ids", [])
+        caption = entry.get("caption", "") or f"Альбом из {len(file_ids)} фото"
+        now = datetime.utcnow()
+        sub = {"type": p_type, "section": section, "topic_id": topic.get("id"),
+               "topic_title": topic.get("title"),
+               "content_type": "photo_album", "content_summary": caption, "photo_file_id": ";".join(file_ids),
+               "date": today_str(), "ts": now.isoformat()}
+        await add_submissions_bulk([(int(uid), sub, None)])
+
+        # save files if conspect; the whole album is fetched concurrently
+        if sub['type'] == 'conspect':
+            stamp = now.strftime('%Y%m%d_%H%M%S')
+            await save_conspect_photos(uid, sub['section'].replace("/", "_"), sub['topic_id'], file_ids,
+                                       [f"photo_{idx}_{stamp}.jpg" for idx in range(1, len(file_ids) + 1)])
+        try:
+            await bot.send_message(int(uid), await get_praise(int(uid), sub['section'], sub['topic_title'], 'photo'))
+        except Exception:
+            pass
+        await notify_admin(int(uid), "📸", f"прислал {sub['type'].upper()} (альбом): {sub['section']} — {sub['topic_title']}")
+    except Exception:
+        logger.exception('Error finalizing media group %s', key)
 
 
 # ADMIN HELPERS
+def _utf16_len(s: str) -> int:
+    # Telegram counts message length in UTF-16 code units: emoji and other astral chars take two
+    return len(s.encode("utf-16-le")) // 2
+
+
+def _split_utf16(s: str, limit: int) -> tuple:
+    units = 0
+    for i, ch in enumerate(s):
+        units += 2 if ord(ch) > 0xFFFF else 1
+        if units > limit:
+            return s[:i], s[i:]
+    return s, ""
+
+
+def iter_message_chunks(lines: List[str], limit: int = 3900):
+    """Join lines into messages of at most limit UTF-16 units, one chunk at a time; longer lines are split."""
+    buf, n = [], 0
+    for line in lines:
+        size = _utf16_len(line)
+        while size > limit:
+            if buf:
+                yield "\n".join(buf)
+                buf, n = [], 0
+            head, line = _split_utf16(line, limit)
+            yield head
+            size = _utf16_len(line)
+        if buf and n + size + 1 > limit:
+            yield "\n".join(buf)
+            buf, n = [], 0
+        buf.append(line)
+        n += size + 1
+    if buf:
+        yield "\n".join(buf)
+
+
+# user_id, username, then the submissions columns in the export SELECT order
+USER_EXPORT_HEADERS = ["user_id", "username", "type", "section", "topic_id", "topic_title", "content_type",
+                       "content_summary", "photo_file_id", "date", "ts"]
+
+
+def _build_export_excel(target_uid: str, username: str, subs: List[tuple]) -> bytes:
+    """Blocking: the user's submissions as an xlsx file, streamed row by row straight from the DB rows."""
+    excel_bio = io.BytesIO()
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("submissions")
+    ws.append(USER_EXPORT_HEADERS)
+    for s in subs:
+        ws.append((target_uid, username, *s))
+    wb.save(excel_bio)
+    return excel_bio.getvalue()
+
+
+def _build_export_zip(user_dir: str, blobs: List[tuple]) -> Optional[bytes]:
+    """Blocking: zip of the user's saved files plus downloaded (name, bytes) blobs; None when there is nothing to pack."""
+    zip_bio = io.BytesIO()
+    with zipfile.ZipFile(zip_bio, mode="w", compression=zipfile.ZIP_DEFLATED, compresslevel=ZIP_DEFLATE_LEVEL) as zf:
+        if os.path.exists(user_dir):
+            for full, arc in iter_folder_files(user_dir):
+                zf.write(full, arc, compress_type=zip_compress_type(full))
+        for name, b in blobs:
+            zf.writestr(name, b, compress_type=zip_compress_type(name))
+        empty = not zf.filelist
+    return None if empty else zip_bio.getvalue()
+
+
+EXPORT_DOWNLOAD_LIMIT = 8
+
+
 async def produce_and_send_user_export(admin_id: int, identifier: str):
     identifier = (identifier or "").lstrip('@').strip()
     target_uid = None
     if identifier.isdigit():
-        cursor.execute('SELECT id FROM users WHERE id = ?', (int(identifier),))
-        r = cursor.fetchone()
+        r = await db_fetchone('SELECT id FROM users WHERE id = ?', (int(identifier),))
         if r:
             target_uid = str(r[0])
     if not target_uid:
-        cursor.execute(
-            'SELECT id, username, first_name FROM users WHERE LOWER(username) = LOWER(?) OR LOWER(first_name) = LOWER(?)',
-            (identifier, identifier))
-        r = cursor.fetchone()
+        r = await db_fetchone(USER_BY_NAME_SQL, (identifier, identifier))
         if r:
             target_uid = str(r[0])
 
@@ -995,108 +1434,112 @@ async def produce_and_send_user_export(admin_id: int, identifier: str):
         return
 
     # fetch submissions
-    cursor.execute(
+    subs = await db_fetchall(
         'SELECT type, section, topic_id, topic_title, content_type, content_summary, photo_file_id, date, ts FROM submissions WHERE user_id = ?',
         (int(target_uid),))
-    subs = cursor.fetchall()
     if not subs:
         await bot.send_message(admin_id, "У пользователя нет отправлений.")
         return
 
-    cursor.execute('SELECT username, first_name FROM users WHERE id = ?', (int(target_uid),))
-    row = cursor.fetchone()
+    row = await db_fetchone('SELECT username, first_name FROM users WHERE id = ?', (int(target_uid),))
     username = (row[0] or row[1]) if row else target_uid
 
     lines = [f"Выгрузка для @{username} (id: {target_uid}). Всего: {len(subs)}"]
     for s in subs:
         lines.append(f"- [{s[0].upper()}] {s[7]} {s[1]} — {s[3]} — {s[5]}")
-    text = "\n".join(lines)
-    for chunk in [text[i:i + 3900] for i in range(0, len(text), 3900)]:
-        await bot.send_message(admin_id, chunk)
 
-    rows = []
-    for s in subs:
-        rows.append({"user_id": target_uid, "username": username, "type": s[0], "section": s[1], "topic_id": s[2],
-                     "topic_title": s[3], "content_type": s[4], "content_summary": s[5], "photo_file_id": s[6],
-                     "date": s[7], "ts": s[8]})
-    excel_bio = io.BytesIO()
-    df = pd.DataFrame(rows)
-    with pd.ExcelWriter(excel_bio, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name="submissions")
-    excel_bio.seek(0)
-    await bot.send_document(admin_id, InputFile(excel_bio, filename=f"user_{target_uid}_submissions.xlsx"))
+    # the Excel build and the photo downloads (each file once, at most EXPORT_DOWNLOAD_LIMIT at a time)
+    # run while the text chunks go out; the chunks themselves stay sequential so they arrive in order
+    fids = list(dict.fromkeys(fid for s in subs if s[6] for fid in (f.strip() for f in str(s[6]).split(";")) if fid))
+    sem = asyncio.Semaphore(EXPORT_DOWNLOAD_LIMIT)
 
-    # prepare zip of saved files
-    zip_bio = io.BytesIO()
-    with zipfile.ZipFile(zip_bio, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
-        user_dir = os.path.join(CONSPECTS_DIR, target_uid)
-        if os.path.exists(user_dir):
-            for root, _, files in os.walk(user_dir):
-                for f in files:
-                    full = os.path.join(root, f)
-                    arc = os.path.relpath(full, user_dir)
-                    zf.write(full, arc)
-        # download photos referenced in submissions
-        for s in subs:
-            pf = s[6]
-            if pf:
-                for fid in str(pf).split(";"):
-                    fid = fid.strip()
-                    if not fid:
-                        continue
-                    b = await download_file_bytes(fid)
-                    if b:
-                        zf.writestr(f"downloaded_{fid[:8]}.jpg", b)
-    zip_bio.seek(0)
-    if zip_bio.getbuffer().nbytes > 0:
-        await bot.send_document(admin_id, InputFile(zip_bio, filename="user_files.zip"))
+    async def fetch(fid):
+        async with sem:
+            return await download_file_bytes(fid)
+
+    excel_job = asyncio.ensure_future(asyncio.to_thread(_build_export_excel, target_uid, username, subs))
+    downloads = asyncio.ensure_future(asyncio.gather(*(fetch(fid) for fid in fids)))
+    try:
+        for chunk in iter_message_chunks(lines):
+            await bot.send_message(admin_id, chunk)
+        excel_bytes = await excel_job
+        await bot.send_document(admin_id, InputFile(io.BytesIO(excel_bytes), filename=f"user_{target_uid}_submissions.xlsx"))
+        downloaded = await downloads
+    except BaseException:
+        excel_job.cancel()
+        downloads.cancel()
+        await asyncio.gather(excel_job, downloads, return_exceptions=True)
+        raise
+
+    # pack everything off the event loop
+    # numbered names: file_ids of one user share long prefixes
+    blobs = [(f"downloaded_{i}.jpg", b) for i, b in enumerate(downloaded, 1) if b]
+    zip_bytes = await asyncio.to_thread(_build_export_zip, os.path.join(CONSPECTS_DIR, target_uid), blobs)
+    if zip_bytes:
+        await bot.send_document(admin_id, InputFile(io.BytesIO(zip_bytes), filename="user_files.zip"))
     else:
         await bot.send_message(admin_id, "У пользователя нет загруженных файлов/фото.")
 
 
-def cleanup_empty_columns():
-    """Очищает пустые столбцы в базе данных"""
+def cleanup_empty_columns(db: sqlite3.Connection) -> bool:
+    """Очищает пустые столбцы в базе данных (через db_call)"""
     try:
-        # Очищаем пустые username
-        cursor.execute("UPDATE users SET username = '' WHERE username IS NULL")
+        # одна транзакция на все UPDATE вместо коммита на каждый
+        with db_transaction(db, "IMMEDIATE"):
+            # Очищаем пустые username
+            db.execute("UPDATE users SET username = '' WHERE username IS NULL")
 
-        # Очищаем пустые first_name
-        cursor.execute("UPDATE users SET first_name = '' WHERE first_name IS NULL")
+            # Очищаем пустые first_name
+            db.execute("UPDATE users SET first_name = '' WHERE first_name IS NULL")
 
-        # Очищаем пустые значения в submissions
-        cursor.execute("UPDATE submissions SET section = '' WHERE section IS NULL")
-        cursor.execute("UPDATE submissions SET topic_id = '' WHERE topic_id IS NULL")
-        cursor.execute("UPDATE submissions SET topic_title = '' WHERE topic_title IS NULL")
-        cursor.execute("UPDATE submissions SET content_type = '' WHERE content_type IS NULL")
-        cursor.execute("UPDATE submissions SET content_summary = '' WHERE content_summary IS NULL")
-        cursor.execute("UPDATE submissions SET photo_file_id = '' WHERE photo_file_id IS NULL")
+            # Очищаем пустые значения в submissions
+            db.execute("UPDATE submissions SET section = '' WHERE section IS NULL")
+            db.execute("UPDATE submissions SET topic_id = '' WHERE topic_id IS NULL")
+            db.execute("UPDATE submissions SET topic_title = '' WHERE topic_title IS NULL")
+            db.execute("UPDATE submissions SET content_type = '' WHERE content_type IS NULL")
+            db.execute("UPDATE submissions SET content_summary = '' WHERE content_summary IS NULL")
+            db.execute("UPDATE submissions SET photo_file_id = '' WHERE photo_file_id IS NULL")
 
-        # Очищаем пустые значения в miss_reasons
-        cursor.execute("UPDATE miss_reasons SET reason = '' WHERE reason IS NULL")
+            # Очищаем пустые значения в miss_reasons
+            db.execute("UPDATE miss_reasons SET reason = '' WHERE reason IS NULL")
 
-        conn.commit()
         return True
     except Exception as e:
         logger.exception("Error cleaning up empty columns")
         return False
 
 
+def delete_user_rows(db: sqlite3.Connection, uid: int):
+    # IMMEDIATE: take the write lock up front, all three deletes share one commit
+    with db_transaction(db, "IMMEDIATE"):
+        db.execute('DELETE FROM submissions WHERE user_id = ?', (uid,))
+        db.execute('DELETE FROM miss_reasons WHERE user_id = ?', (uid,))
+        # Удаляем самого пользователя из таблицы users
+        db.execute('DELETE FROM users WHERE id = ?', (uid,))
+
+
+def delete_all_rows(db: sqlite3.Connection):
+    with db_transaction(db, "IMMEDIATE"):
+        db.execute('DELETE FROM submissions')
+        db.execute('DELETE FROM miss_reasons')
+        db.execute('DELETE FROM users')
+        # full_history.xlsx is rebuilt from this table; a reset starts the history over
+        db.execute('DELETE FROM full_history')
+
+
 async def delete_user_submissions(admin_id: int, identifier: str):
     identifier = (identifier or "").lstrip('@').strip()
     target_uid = None
 
     # Поиск по ID
     if identifier.isdigit():
-        cursor.execute('SELECT id FROM users WHERE id = ?', (int(identifier),))
-        result = cursor.fetchone()
+        result = await db_fetchone('SELECT id FROM users WHERE id = ?', (int(identifier),))
         if result:
             target_uid = str(result[0])
 
     # Поиск по username или first_name
     if not target_uid:
-        cursor.execute('SELECT id FROM users WHERE LOWER(username) = LOWER(?) OR LOWER(first_name) = LOWER(?)',
-                       (identifier, identifier))
-        result = cursor.fetchone()
+        result = await db_fetchone(USER_BY_NAME_SQL, (identifier, identifier))
         if result:
             target_uid = str(result[0])
 
@@ -1106,19 +1549,16 @@ async def delete_user_submissions(admin_id: int, identifier: str):
 
     try:
         # Удаляем все данные пользователя
-        cursor.execute('DELETE FROM submissions WHERE user_id = ?', (int(target_uid),))
-        cursor.execute('DELETE FROM miss_reasons WHERE user_id = ?', (int(target_uid),))
-
-        # Удаляем самого пользователя из таблицы users
-        cursor.execute('DELETE FROM users WHERE id = ?', (int(target_uid),))
-
-        conn.commit()
+        await db_call(delete_user_rows, int(target_uid))
+        invalidate_user_cache(int(target_uid))
+        _sub_counts.pop(int(target_uid), None)
 
         # Удаляем файлы пользователя
         user_dir = os.path.join(CONSPECTS_DIR, target_uid)
         if os.path.exists(user_dir):
             try:
-                shutil.rmtree(user_dir)
+                # one rmtree pass (fd-based on Linux), in a worker thread: big folders don't stall the loop
+                await asyncio.to_thread(shutil.rmtree, user_dir)
             except Exception as e:
                 logger.error(f"Error removing user directory: {e}")
 
@@ -1134,11 +1574,12 @@ async def delete_user_submissions(admin_id: int, identifier: str):
 # ADMIN HANDLERS (callbacks & pending)
 @dp.callback_query_handler(lambda c: c.data and c.data.startswith("admin|"))
 async def cb_admin(call: types.CallbackQuery):
-    if call.from_user.id != ADMIN_ID:
+    admin_id = call.from_user.id
+    if admin_id != ADMIN_ID:
         return await call.answer("Нет доступа", show_alert=True)
 
     action = call.data.split("|", 1)[1]
-    aid = str(call.from_user.id)
+    aid = str(admin_id)
 
     if action == "daily_full":
         await send_daily_excel_to_admin(date.today())
@@ -1151,31 +1592,30 @@ async def cb_admin(call: types.CallbackQuery):
         return
 
     if action == "new_report":
-        bio = make_daily_excel(date.today())
-        fname = f"daily_report_{date.today().isoformat()}_{int(time.time())}.xlsx"
-        await bot.send_document(call.from_user.id, InputFile(bio, filename=fname))
+        fpath = await asyncio.to_thread(make_daily_excel, date.today())
+        with open(fpath, "rb") as f:
+            await bot.send_document(admin_id, InputFile(f, filename=os.path.basename(fpath)))
         await call.answer("Создан и отправлен отчёт (сохранён в reports).")
         return
 
     if action == "cleanup_columns":
-        if cleanup_empty_columns():
-            await bot.send_message(call.from_user.id, "✅ Пустые столбцы успешно очищены.")
+        if await db_call(cleanup_empty_columns):
+            invalidate_user_cache()
+            await bot.send_message(admin_id, "✅ Пустые столбцы успешно очищены.")
         else:
-            await bot.send_message(call.from_user.id, "❌ Ошибка при очистке пустых столбцов.")
+            await bot.send_message(admin_id, "❌ Ошибка при очистке пустых столбцов.")
         await call.answer()
         return
 
     if action == "full_history_manual":
         # run update and send PNGs + excel immediately
-        cursor.execute('SELECT DISTINCT date FROM submissions ORDER BY date')
-        dates = [parse_date(r[0]) for r in cursor.fetchall() if parse_date(r[0])]
+        rows = await db_fetchall('SELECT DISTINCT date FROM submissions ORDER BY date')
+        dates = [d for d in (parse_date(r[0]) for r in rows) if d]
         if not dates:
-            await bot.send_message(call.from_user.id, "Нет данных для исторического отчёта.")
+            await bot.send_message(admin_id, "Нет данных для исторического отчёта.")
             await call.answer()
             return
-        for d in dates:
-            update_full_history_excel(d)
-        # create charts inside excel and PNGs & send
+        # records every date, creates charts inside excel and PNGs & sends
         await update_full_history_daily()
         await call.answer("Исторический отчёт и графики отправлены.")
         return
@@ -1192,50 +1632,52 @@ async def cb_admin(call: types.CallbackQuery):
                     deleted += 1
                 except Exception:
                     pass
-            await bot.send_message(call.from_user.id, f"Удалено {deleted} файлов из папки reports.")
+            # the history sheet is regenerated from the table, so clear it too or the rows come back
+            await db_exec('DELETE FROM full_history')
+            await bot.send_message(admin_id, f"Удалено {deleted} файлов из папки reports.")
         except Exception:
-            await bot.send_message(call.from_user.id, "Ошибка при удалении отчётов.")
+            await bot.send_message(admin_id, "Ошибка при удалении отчётов.")
         await call.answer()
         return
 
     if action == "export_user":
         admin_pending[aid] = {"action": "export_user"}
-        await bot.send_message(call.from_user.id, "Введи ID или username ученика для выгрузки (можно с @):")
+        await bot.send_message(admin_id, "Введи ID или username ученика для выгрузки (можно с @):")
         await call.answer()
         return
 
     if action == "delete_user":
         admin_pending[aid] = {"action": "delete_user"}
-        await bot.send_message(call.from_user.id, "Введи ID или username ученика для удаления (можно с @):")
+        await bot.send_message(admin_id, "Введи ID или username ученика для удаления (можно с @):")
         await call.answer()
         return
 
     if action == "reset_all":
         try:
-            cursor.execute('DELETE FROM submissions')
-            cursor.execute('DELETE FROM miss_reasons')
-            cursor.execute('DELETE FROM users')
-            conn.commit()
+            await db_call(delete_all_rows)
+            invalidate_user_cache()
+            _sub_counts.clear()
             if os.path.exists(CONSPECTS_DIR):
-                shutil.rmtree(CONSPECTS_DIR)
+                await asyncio.to_thread(shutil.rmtree, CONSPECTS_DIR)
                 os.makedirs(CONSPECTS_DIR, exist_ok=True)
-            await bot.send_message(call.from_user.id, "Все данные и файлы сброшены.")
+            await bot.send_message(admin_id, "Все данные и файлы сброшены.")
         except Exception:
             logger.exception("reset_all error")
-            await bot.send_message(call.from_user.id, "Ошибка при сбросе данных.")
+            await bot.send_message(admin_id, "Ошибка при сбросе данных.")
         await call.answer()
         return
 
     if action == "cancel":
-        await bot.send_message(call.from_user.id, "Операция отменена.", reply_markup=admin_kb())
+        await bot.send_message(admin_id, "Операция отменена.", reply_markup=admin_kb())
         await call.answer()
         return
 
 
 @dp.message_handler(lambda m: str(m.from_user.id) in admin_pending)
 async def admin_pending_text(message: types.Message):
-    aid = str(message.from_user.id)
-    if message.from_user.id != ADMIN_ID:
+    admin_id = message.from_user.id
+    aid = str(admin_id)
+    if admin_id != ADMIN_ID:
         return
 
     task = admin_pending.pop(aid, None)
@@ -1246,12 +1688,12 @@ async def admin_pending_text(message: types.Message):
     identifier = message.text.strip()
 
     if action == "export_user":
-        await produce_and_send_user_export(message.from_user.id, identifier)
+        await produce_and_send_user_export(admin_id, identifier)
         await message.answer("Выгрузка завершена.", reply_markup=admin_kb())
         return
 
     if action == "delete_user":
-        success = await delete_user_submissions(message.from_user.id, identifier)
+        success = await delete_user_submissions(admin_id, identifier)
         if success:
             await message.answer("✅ Удаление выполнено.", reply_markup=admin_kb())
         else:
@@ -1272,13 +1714,13 @@ async def cmd_get_user(message: types.Message):
             return await message.answer("Использование: /get_user <user_id>")
 
         user_id = int(args.strip())
-        username = get_username_by_id(user_id)
-        display_name = get_user_display_name_by_id(user_id)
+        username = await get_username_by_id(user_id)
+        display_name = await get_user_display_name_by_id(user_id)
 
         response = f"ID: {user_id}\n"
         response += f"Username: @{username}\n" if username else "Username: не установлен\n"
         response += f"Display name: {display_name}\n"
-        response += f"Упоминание: {mention_html_by_id(user_id)}"
+        response += f"Упоминание: {await mention_html_by_id(user_id)}"
 
         await message.answer(response, parse_mode="HTML")
 
@@ -1302,8 +1744,8 @@ async def cmd_update_user(message: types.Message):
         user_id = int(args.strip())
         await ensure_user_with_current_data(user_id)
 
-        username = get_username_by_id(user_id)
-        display_name = get_user_display_name_by_id(user_id)
+        username = await get_username_by_id(user_id)
+        display_name = await get_user_display_name_by_id(user_id)
 
         await message.answer(
             f"Данные пользователя обновлены:\n"
@@ -1321,17 +1763,47 @@ async def cmd_update_user(message: types.Message):
 
 
 # ---------------- SCHEDULER TASKS ----------------
-async def daily_reminder():
-    try:
-        cursor.execute('SELECT id FROM users')
-        rows = cursor.fetchall()
-        for row in rows:
-            uid = row[0]
+# broadcasts share one limit so they stay under Telegram's ~30 msg/s: at most BROADCAST_LIMIT
+# sends in flight, and their starts spaced 1/BROADCAST_RATE s apart (concurrency alone allows
+# far more than 30/s when replies come back fast)
+_broadcast_sem = asyncio.Semaphore(BROADCAST_LIMIT)
+BROADCAST_RATE = 25
+_broadcast_next_at = 0.0
+
+
+async def _broadcast_pace():
+    global _broadcast_next_at
+    now = asyncio.get_running_loop().time()
+    slot = max(now, _broadcast_next_at)
+    _broadcast_next_at = slot + 1 / BROADCAST_RATE
+    if slot > now:
+        await asyncio.sleep(slot - now)
+
+
+async def send_limited(uid, text: str) -> bool:
+    """send_message under the broadcast limit; False if delivery failed."""
+    async with _broadcast_sem:
+        for attempt in range(2):
+            await _broadcast_pace()
             try:
-                await bot.send_message(int(uid),
-                                       "⏰ Напоминание: не забудьте сегодня сдать ДЗ и/или конспект. Нажми в меню 'Сдать ДЗ' или 'Сдать конспект'.")
+                await bot.send_message(int(uid), text)
+                return True
+            except RetryAfter as e:
+                # flood control: wait as told and try once more
+                if attempt:
+                    return False
+                await asyncio.sleep(e.timeout)
             except Exception:
-                pass
+                return False
+        return False
+
+
+async def daily_reminder():
+    try:
+        rows = await db_fetchall('SELECT id FROM users')
+        await asyncio.gather(*(send_limited(
+            row[0], "⏰ Напоминание: не забудьте сегодня сдать ДЗ и/или конспект. Нажми в меню 'Сдать ДЗ' или 'Сдать конспект'.")
+            for row in rows))
     except Exception:
         logger.exception("daily_reminder error")
 
@@ -1340,25 +1812,19 @@ async def ask_missed_reason():
     """Исправленная функция: спрашивает причину пропуска только у тех, кто ничего не сдал за день"""
     dstr = today_str()
     try:
-        # Получаем всех пользователей
-        cursor.execute('SELECT id FROM users')
-        all_uids = {r[0] for r in cursor.fetchall()}
-
-        # Получаем пользователей, которые сдали что-либо сегодня
-        cursor.execute('SELECT DISTINCT user_id FROM submissions WHERE date = ?', (dstr,))
-        submitted_uids = {r[0] for r in cursor.fetchall()}
+        # Спрашиваем только тех, кто ничего не сдал сегодня (anti-join по idx_sub_user_date_ts)
+        rows = await db_fetchall('SELECT u.id FROM users u WHERE NOT EXISTS '
+                                 '(SELECT 1 FROM submissions s WHERE s.user_id = u.id AND s.date = ?)', (dstr,))
+        to_ask = [r[0] for r in rows]
 
-        # Спрашиваем только тех, кто ничего не сдал
-        to_ask = all_uids - submitted_uids
+        text = f"Сегодня ({dstr}) ты ничего не сдал(а). Можешь коротко указать причину пропуска? (ответ будет сохранён)"
 
-        for uid in to_ask:
-            try:
-                reasons_pending[str(uid)] = dstr
-                await bot.send_message(int(uid),
-                                       f"Сегодня ({dstr}) ты ничего не сдал(а). Можешь коротко указать причину пропуска? (ответ будет сохранён)")
-            except Exception:
+        async def ask(uid):
+            reasons_pending[str(uid)] = dstr
+            if not await send_limited(uid, text):
                 reasons_pending.pop(str(uid), None)
-                pass
+
+        await asyncio.gather(*(ask(uid) for uid in to_ask))
     except Exception:
         logger.exception("ask_missed_reason error")
 
@@ -1366,10 +1832,11 @@ async def ask_missed_reason():
 async def daily_admin_report():
     d = today_str()
     try:
-        cursor.execute('SELECT COUNT(*) FROM submissions WHERE date = ? AND type = ?', (d, 'dz'))
-        dz = cursor.fetchone()[0]
-        cursor.execute('SELECT COUNT(*) FROM submissions WHERE date = ? AND type = ?', (d, 'conspect'))
-        cons = cursor.fetchone()[0]
+        # both counts in one pass over idx_sub_date_type
+        counts = dict(await db_fetchall("SELECT type, COUNT(*) FROM submissions WHERE date = ? "
+                                        "AND type IN ('dz', 'conspect') GROUP BY type", (d,)))
+        dz = counts.get('dz', 0)
+        cons = counts.get('conspect', 0)
         text = f"Ежедневный отчёт за {d}:\nДЗ: {dz}\nКонспект: {cons}\nДля подробностей нажми в админ-панели 'Дневной отчёт (подробный)'."
         await bot.send_message(ADMIN_ID, text)
     except Exception:
@@ -1377,182 +1844,225 @@ async def daily_admin_report():
 
 
 # ---------------- FULL HISTORY, CHARTS AND TOPS ----------------
-def update_full_history_excel(target_date: date):
-    """
-    Append one row per user for target_date into single sheet "ALL".
-    Ensures clickable HYPERLINK formulas to tg://user?id=..., fills task_flag,
-    skips rows with dz==0 and conspect==0 and empty reason, and avoids duplicates.
+# per-user day stats for the ALL sheet in one pass: counts by type, miss reason and the latest submission;
+# users already recorded in full_history for the date are left out
+FULL_HISTORY_DAY_SQL = '''
+    WITH day AS (
+        SELECT user_id, type, topic_id, topic_title, message_id,
+               ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY ts DESC) AS rn
+        FROM submissions
+        WHERE date = ?
+    )
+    SELECT u.id, u.username, u.first_name,
+           COUNT(CASE WHEN d.type = 'dz' THEN 1 END),
+           COUNT(CASE WHEN d.type = 'conspect' THEN 1 END),
+           mr.reason,
+           MAX(CASE WHEN d.rn = 1 THEN d.topic_id END),
+           MAX(CASE WHEN d.rn = 1 THEN d.topic_title END),
+           MAX(CASE WHEN d.rn = 1 THEN d.message_id END)
+    FROM users u
+    LEFT JOIN day d ON d.user_id = u.id
+    LEFT JOIN miss_reasons mr ON mr.user_id = u.id AND mr.date = ?
+    WHERE NOT EXISTS (SELECT 1 FROM full_history fh WHERE fh.user_id = u.id AND fh.date = ?)
+    GROUP BY u.id
+    ORDER BY u.id
+'''
+
+
+FULL_HISTORY_HEADERS = ["user_id", "name", "tag", "date", "dz", "conspect", "miss_reason", "task_flag", "MessageLink"]
+FULL_HISTORY_COLUMNS = "user_id, name, tag, date, dz, conspect, miss_reason, task_flag, message_id"
+_HYPERLINK_TEXT_RE = re.compile(r'^=HYPERLINK\("[^"]*",\s*"(.*)"\)$')
+_MESSAGE_ID_RE = re.compile(r'message_id=(\d+)')
+
+
+def _import_legacy_full_history(db: sqlite3.Connection, path: str) -> bool:
+    """One-off: seed an empty full_history table from the rows of an xlsx written before the table existed.
+
+    False when the file could not be imported; it is then the only copy of that history.
     """
-    path = os.path.join(REPORTS_DIR, "full_history.xlsx")
-    # ensure file exists with sheet ALL
-    if not os.path.exists(path):
-        # create with header
-        from openpyxl import Workbook
-        wb_new = Workbook()
-        ws_new = wb_new.active
-        ws_new.title = "ALL"
-        headers = ["user_id", "name", "tag", "date", "dz", "conspect", "miss_reason", "task_flag", "MessageLink"]
-        for i, h in enumerate(headers, start=1):
-            ws_new.cell(row=1, column=i, value=h)
-        wb_new.save(path)
-
-    wb = load_workbook(path)
-    if "ALL" not in wb.sheetnames:
-        wb.create_sheet("ALL")
-    ws = wb["ALL"]
-
-    # build set of existing (user_id, date) to avoid duplicates
-    existing = set()
-    for row in ws.iter_rows(min_row=2, values_only=True):
+    if db.execute('SELECT 1 FROM full_history LIMIT 1').fetchone() or not os.path.exists(path):
+        return True
+    try:
+        wb = load_workbook(path, read_only=True)
         try:
-            uid = row[0]  # user_id is now first column
-            d = row[3]  # date is now 4th column
-            existing.add((str(uid), str(d)))
-        except Exception:
-            pass
+            if "ALL" not in wb.sheetnames:
+                return True
+            sheet_rows = wb["ALL"].iter_rows(values_only=True)
+            col = {str(h).strip(): i for i, h in enumerate(next(sheet_rows, ())) if h is not None}
+            if "user_id" not in col or "date" not in col:
+                raise ValueError(f"unexpected ALL header: {sorted(col)}")
+
+            def cell(r: tuple, name: str):
+                i = col.get(name)
+                return r[i] if i is not None and i < len(r) else None
+
+            rows = []
+            for r in sheet_rows:
+                uid, dstr = cell(r, "user_id"), cell(r, "date")
+                if uid is None or dstr is None:
+                    continue
+                # older files stored the name as a =HYPERLINK(...) formula
+                name = str(cell(r, "name") or "")
+                m = _HYPERLINK_TEXT_RE.match(name)
+                mid = _MESSAGE_ID_RE.search(str(cell(r, "MessageLink") or ""))
+                # same order as FULL_HISTORY_COLUMNS
+                rows.append((int(uid), m.group(1) if m else name, cell(r, "tag") or "", str(dstr),
+                             int(cell(r, "dz") or 0), int(cell(r, "conspect") or 0), cell(r, "miss_reason") or "",
+                             cell(r, "task_flag") or "", int(mid.group(1)) if mid else None))
+        finally:
+            wb.close()
+        with db_transaction(db):
+            db.executemany(f'INSERT OR IGNORE INTO full_history ({FULL_HISTORY_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           rows)
+    except Exception:
+        logger.exception("importing legacy full_history.xlsx failed")
+        return False
+    return True
+
+
+def _full_history_cells(row: tuple) -> tuple:
+    uid, name_value, tag_value, dstr, dz, cons, reason, task_flag, mid = row
+    # clickable name and message link as cell hyperlinks (no formula strings to escape)
+    msg_url = f"tg://openmessage?chat_id={uid}&message_id={mid}" if mid else None
+    values = (uid, name_value, tag_value, dstr, dz, cons, reason, task_flag, "Open" if mid else "")
+    links = (None, f"tg://user?id={uid}", None, None, None, None, None, None, msg_url)
+    return values, links
+
+
+def write_full_history_xlsx(db: sqlite3.Connection) -> str:
+    """Regenerate full_history.xlsx in one write-only pass: "ALL" from the full_history table,
+    then the Chart_DZ / Chart_Conspects per-date counts."""
+    path = os.path.join(REPORTS_DIR, "full_history.xlsx")
+    with db_transaction(db):
+        rows = db.execute(f'SELECT {FULL_HISTORY_COLUMNS} FROM full_history ORDER BY rowid').fetchall()
+        dz_rows = db.execute("SELECT date, COUNT(*) FROM submissions WHERE type='dz' GROUP BY date ORDER BY date").fetchall()
+        c_rows = db.execute("SELECT date, COUNT(*) FROM submissions WHERE type='conspect' GROUP BY date ORDER BY date").fetchall()
+    cells = [_full_history_cells(r) for r in rows]
+
+    wb = Workbook(write_only=True)
+    add_report_styles(wb)
+    ws = wb.create_sheet("ALL")
+    ws.freeze_panes = "A2"
+    _set_column_widths(ws, FULL_HISTORY_HEADERS, [values for values, _ in cells])
+    ws.append(_header_cells(ws, FULL_HISTORY_HEADERS))
+    for values, links in cells:
+        ws.append([_body_cell(ws, v, link) for v, link in zip(values, links)])
+
+    # summary sheets for DZ & conspects
+    for title, header, counts in (("Chart_DZ", ["date", "dz_count"], dz_rows),
+                                  ("Chart_Conspects", ["date", "cons_count"], c_rows)):
+        ws_chart = wb.create_sheet(title)
+        ws_chart.append(header)
+        for r in counts:
+            ws_chart.append(r)
+    wb.save(path)
+    return path
+
 
+def record_full_history_day(target_date: date, db: sqlite3.Connection):
+    """
+    Record one row per user for target_date in full_history (runs inside the caller's transaction).
+    Fills task_flag, skips rows with dz==0 and conspect==0 and empty reason;
+    the first row written for a (user, date) is kept.
+    """
     dstr = target_date.isoformat()
 
-    # iterate users from DB and compute statuses
+    # all users with their statuses for the date, one query
     try:
-        cursor.execute('SELECT id, username, first_name FROM users ORDER BY id')
-        users = cursor.fetchall()
+        users = db.execute(FULL_HISTORY_DAY_SQL, (dstr, dstr, dstr)).fetchall()
     except Exception:
+        logger.exception("full history stats query failed")
         users = []
 
-    rows_to_append = []
-    for u in users:
-        uid, uname, fname = u
-        uid_s = str(uid)
-        # skip if already present for that date
-        if (uid_s, dstr) in existing:
-            continue
-        # compute dz and cons presence
-        try:
-            cursor.execute('SELECT COUNT(*) FROM submissions WHERE user_id = ? AND date = ? AND type = ?',
-                           (uid, dstr, 'dz'))
-            dz = cursor.fetchone()[0] or 0
-            cursor.execute('SELECT COUNT(*) FROM submissions WHERE user_id = ? AND date = ? AND type = ?',
-                           (uid, dstr, 'conspect'))
-            cons = cursor.fetchone()[0] or 0
-            cursor.execute('SELECT reason FROM miss_reasons WHERE user_id = ? AND date = ?', (uid, dstr))
-            rr = cursor.fetchone()
-            reason = rr[0] if rr and rr[0] else ""
-            # task_flag: last submission topic_id or topic_title
-            cursor.execute(
-                'SELECT topic_id, topic_title FROM submissions WHERE user_id = ? AND date = ? ORDER BY ts DESC LIMIT 1',
-                (uid, dstr))
-            trow = cursor.fetchone()
-            task_flag = ""
-            if trow:
-                task_flag = trow[0] or trow[1] or ""
-        except Exception:
-            dz = 0;
-            cons = 0;
-            reason = "";
-            task_flag = ""
+    rows_to_record = []
+    for uid, uname, fname, dz, cons, reason, topic_id, topic_title, mid in users:
+        reason = reason or ""
+        # task_flag: last submission topic_id or topic_title
+        task_flag = topic_id or topic_title or ""
 
         # skip empty rows: dz==0 and cons==0 and no reason
         if (int(dz) == 0) and (int(cons) == 0) and (not str(reason).strip()):
             continue
 
-        # build name and tag
-        # name: first_name or user_123 - but now as clickable link
+        # name: first_name or user_123 (made clickable in the sheet)
         if fname and str(fname).strip():
             name_value = fname
         else:
             name_value = f"user_{uid}"
 
-        # Create clickable name using HYPERLINK formula
-        clickable_name = f'=HYPERLINK("tg://user?id={uid}", "{name_value}")'
-
         # tag: @username if exists else ""
         if uname and str(uname).strip():
             tag_value = f"@{uname}"
         else:
             tag_value = ""
 
-        # message link
-        try:
-            cursor.execute('SELECT message_id FROM submissions WHERE user_id = ? AND date = ? ORDER BY ts DESC LIMIT 1',
-                           (uid, dstr))
-            mid_row = cursor.fetchone()
-            mid = mid_row[0] if mid_row and mid_row[0] else None
-        except Exception:
-            mid = None
+        rows_to_record.append((uid, name_value, tag_value, dstr, int(dz), int(cons), reason, task_flag, mid or None))
 
-        if mid:
-            msg_link = f'=HYPERLINK("tg://openmessage?chat_id={uid}&message_id={mid}", "Open")'
-        else:
-            msg_link = ""
+    # INSERT OR IGNORE as a guard; already recorded users were filtered out by the query
+    db.executemany(f'INSERT OR IGNORE INTO full_history ({FULL_HISTORY_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                   rows_to_record)
 
-        rows_to_append.append(
-            (uid, clickable_name, tag_value, dstr, int(dz), int(cons), reason or "", task_flag or "", msg_link))
 
-    # append rows to sheet
-    for r in rows_to_append:
-        next_row = ws.max_row + 1
-        for ci, val in enumerate(r, start=1):
-            cell = ws.cell(row=next_row, column=ci, value=val)
-            # For name column (column 2), set as formula if it contains HYPERLINK
-            if ci == 2 and isinstance(val, str) and 'HYPERLINK' in val:
-                cell.value = val  # This will be interpreted as formula by Excel
+# chat-sized PNGs: 80 dpi; optimize=True makes PIL deflate at level 9 (any compress_level is ignored)
+CHART_PNG_OPTS = {'format': 'png', 'bbox_inches': 'tight', 'dpi': 80,
+                  'pil_kwargs': {'optimize': True}}
 
-    # style worksheet and autosize
-    try:
-        style_worksheet(ws)
-        ws.freeze_panes = ws['A2']
-    except Exception:
-        pass
 
-    wb.save(path)
+def warm_matplotlib():
+    """Render a throwaway figure so the font manager is loaded before the first real chart (blocking)."""
+    fig = Figure(figsize=(1, 1))
+    fig.subplots().set_title('Тест')
+    fig.savefig(_BytesIO(), format='png')
 
 
 def generate_miss_graph_by_student_png() -> _BytesIO:
-    """Generate PNG showing number of misses per student (overall) and return BytesIO."""
+    """Generate PNG showing number of misses per student (overall) and return BytesIO.
+
+    Blocking (queries + rendering): run it via asyncio.to_thread.
+    """
     # count misses from miss_reasons table and also infer misses by days without submissions
     try:
+        db = thread_db()
         # Number of days tracked
-        cursor.execute('SELECT COUNT(DISTINCT date) FROM submissions')
-        days_row = cursor.fetchone()
+        days_row = db.execute('SELECT COUNT(DISTINCT date) FROM submissions').fetchone()
         total_days = days_row[0] if days_row and days_row[0] else 0
 
+        # names for every user in one SELECT
+        names = load_user_names(db)
+
         # Count misses recorded in miss_reasons
-        cursor.execute('SELECT user_id, COUNT(*) as cnt FROM miss_reasons GROUP BY user_id ORDER BY cnt DESC')
-        rows = cursor.fetchall()
+        rows = db.execute('SELECT user_id, COUNT(*) as cnt FROM miss_reasons GROUP BY user_id ORDER BY cnt DESC').fetchall()
         users = []
         counts = []
         for uid, cnt in rows:
-            cursor.execute('SELECT username, first_name FROM users WHERE id = ?', (uid,))
-            r = cursor.fetchone()
+            r = names.get(uid)
             name = (('@' + r[0]) if r and r[0] else (r[1] if r and r[1] else f'user_{uid}'))
             users.append(name)
             counts.append(cnt)
 
         # If no explicit miss_reasons, try infer by checking days without submissions per user
         if not rows:
-            cursor.execute('SELECT id, username, first_name FROM users')
-            all_users = cursor.fetchall()
-            for u in all_users:
-                uid, uname, fname = u
-                cursor.execute('SELECT COUNT(DISTINCT date) FROM submissions WHERE user_id = ?', (uid,))
-                sub_days = cursor.fetchone()[0] or 0
+            sub_days_map = dict(db.execute(
+                'SELECT user_id, COUNT(DISTINCT date) FROM submissions GROUP BY user_id').fetchall())
+            for uid, (uname, fname) in names.items():
+                sub_days = sub_days_map.get(uid, 0)
                 misses = max(0, total_days - sub_days) if total_days > 0 else 0
                 users.append(('@' + uname) if uname else (fname or f'user_{uid}'))
                 counts.append(misses)
 
         # plot bar chart
-        fig, ax = plt.subplots(figsize=(8, max(4, len(users) * 0.4)))
+        # plain Figure (no pyplot): no global figure registry, nothing to close
+        fig = Figure(figsize=(8, max(4, len(users) * 0.4)))
+        ax = fig.subplots()
         ax.bar(range(len(users)), counts)
         ax.set_xticks(range(len(users)))
         ax.set_xticklabels(users, rotation=45, ha='right')
         ax.set_ylabel('Пропуски (кол-во дней)')
         ax.set_title('Пропуски по ученикам (всего)')
-        plt.tight_layout()
+        fig.tight_layout()
 
         bio = _BytesIO()
-        fig.savefig(bio, format='png', bbox_inches='tight')
-        plt.close(fig)
+        fig.savefig(bio, **CHART_PNG_OPTS)
         bio.seek(0)
         return bio
     except Exception:
@@ -1561,42 +2071,42 @@ def generate_miss_graph_by_student_png() -> _BytesIO:
 
 
 def generate_top_students_png(kind: str = "dz", top_n: int = 10) -> _BytesIO:
-    """Generate PNG of top students by submissions of `kind` ('dz' or 'conspect')."""
+    """Generate PNG of top students by submissions of `kind` ('dz' or 'conspect'). Blocking: run via asyncio.to_thread."""
     try:
-        cursor.execute(
+        db = thread_db()
+        names = load_user_names(db)
+        rows = db.execute(
             'SELECT user_id, COUNT(*) as cnt FROM submissions WHERE type = ? GROUP BY user_id ORDER BY cnt DESC LIMIT ?',
-            (kind, top_n))
-        rows = cursor.fetchall()
+            (kind, top_n)).fetchall()
         users = []
         counts = []
         for uid, cnt in rows:
-            cursor.execute('SELECT username, first_name FROM users WHERE id = ?', (uid,))
-            r = cursor.fetchone()
+            r = names.get(uid)
             name = (('@' + r[0]) if r and r[0] else (r[1] if r and r[1] else f'user_{uid}'))
             users.append(name)
             counts.append(cnt)
 
         if not rows:
             bio = _BytesIO()
-            fig, ax = plt.subplots(figsize=(6, 3))
+            fig = Figure(figsize=(6, 3))
+            ax = fig.subplots()
             ax.text(0.5, 0.5, 'Нет данных', ha='center', va='center')
-            plt.axis('off')
-            fig.savefig(bio, format='png', bbox_inches='tight')
-            plt.close(fig)
+            ax.axis('off')
+            fig.savefig(bio, **CHART_PNG_OPTS)
             bio.seek(0)
             return bio
 
-        fig, ax = plt.subplots(figsize=(8, max(3, len(users) * 0.4)))
+        fig = Figure(figsize=(8, max(3, len(users) * 0.4)))
+        ax = fig.subplots()
         ax.bar(range(len(users)), counts)
         ax.set_xticks(range(len(users)))
         ax.set_xticklabels(users, rotation=45, ha='right')
         ax.set_ylabel('Кол-во отправлений')
         ax.set_title('Топ учеников по ' + ('ДЗ' if kind == 'dz' else 'конспектам'))
-        plt.tight_layout()
+        fig.tight_layout()
 
         bio = _BytesIO()
-        fig.savefig(bio, format='png', bbox_inches='tight')
-        plt.close(fig)
+        fig.savefig(bio, **CHART_PNG_OPTS)
         bio.seek(0)
         return bio
     except Exception:
@@ -1604,75 +2114,73 @@ def generate_top_students_png(kind: str = "dz", top_n: int = 10) -> _BytesIO:
         return _BytesIO()
 
 
+def rebuild_full_history() -> Optional[str]:
+    """Record new dates and regenerate full_history.xlsx; None when there is nothing to report.
+
+    Blocking: run it via asyncio.to_thread.
+    """
+    db = thread_db()
+    path = os.path.join(REPORTS_DIR, "full_history.xlsx")
+    if not _import_legacy_full_history(db, path):
+        # keep the unimported file instead of overwriting it below
+        try:
+            os.replace(path, os.path.join(REPORTS_DIR, "full_history.legacy.xlsx"))
+        except OSError:
+            logger.exception("moving legacy full_history.xlsx aside failed")
+            return None
+    # record new dates in one transaction. Dates already in full_history are final, except the
+    # last two days: late submissions and miss reasons (asked at 23:57) still land there
+    recent = (date.today() - timedelta(days=1)).isoformat()
+    with db_transaction(db, "IMMEDIATE"):
+        if db.execute('SELECT 1 FROM submissions LIMIT 1').fetchone() is None:
+            return None
+        rows = db.execute(
+            'SELECT DISTINCT date FROM submissions '
+            'WHERE date >= ? OR date NOT IN (SELECT DISTINCT date FROM full_history) ORDER BY date',
+            (recent,),
+        ).fetchall()
+        for d in (parse_date(r[0]) for r in rows):
+            if d:
+                record_full_history_day(d, db)
+    # ALL sheet plus chart summary sheets, built and saved once
+    return write_full_history_xlsx(db)
+
+
+async def send_admin_image(bio: _BytesIO, filename: str):
+    """Send a PNG to the admin as a photo, falling back to a document."""
+    try:
+        await bot.send_photo(ADMIN_ID, photo=InputFile(bio, filename=filename))
+    except Exception:
+        bio.seek(0)  # the failed upload may have consumed the buffer
+        try:
+            await bot.send_document(ADMIN_ID, InputFile(bio, filename=filename))
+        except Exception:
+            pass
+
+
 async def update_full_history_daily():
     """Regenerate full_history.xlsx (sheets for each date), charts and PNGs, and send to ADMIN."""
     try:
-        cursor.execute('SELECT DISTINCT date FROM submissions ORDER BY date')
-        dates = [parse_date(r[0]) for r in cursor.fetchall() if parse_date(r[0])]
-        if not dates:
+        path = await asyncio.to_thread(rebuild_full_history)
+        if not path:
             return
 
-        for d in dates:
-            update_full_history_excel(d)
-
-        # create charts inside excel: summary sheets for DZ & conspects
-        path = os.path.join(REPORTS_DIR, "full_history.xlsx")
-        wb = load_workbook(path)
-
-        # remove old summary sheets if present
-        for name in ("Chart_DZ", "Chart_Conspects"):
-            if name in wb.sheetnames:
-                wb.remove(wb[name])
-
-        # DZ summary
-        cursor.execute("SELECT date, COUNT(*) FROM submissions WHERE type='dz' GROUP BY date ORDER BY date")
-        dz_rows = cursor.fetchall()
-        ws1 = wb.create_sheet("Chart_DZ")
-        ws1.append(["date", "dz_count"])
-        for r in dz_rows:
-            ws1.append([r[0], r[1]])
-
-        # Conspects summary
-        cursor.execute("SELECT date, COUNT(*) FROM submissions WHERE type='conspect' GROUP BY date ORDER BY date")
-        c_rows = cursor.fetchall()
-        ws2 = wb.create_sheet("Chart_Conspects")
-        ws2.append(["date", "cons_count"])
-        for r in c_rows:
-            ws2.append([r[0], r[1]])
-
-        wb.save(path)
-
-        # generate PNGs
-        miss_png = generate_miss_graph_by_student_png()
-        top_dz_png = generate_top_students_png('dz')
-        top_cons_png = generate_top_students_png('conspect')
-
-        # send to admin: three PNGs as documents
-        try:
-            await bot.send_photo(ADMIN_ID, photo=InputFile(miss_png, filename='misses_by_student.png'))
-        except Exception:
-            try:
-                await bot.send_document(ADMIN_ID, InputFile(miss_png, filename='misses_by_student.png'))
-            except Exception:
-                pass
-        try:
-            await bot.send_photo(ADMIN_ID, photo=InputFile(top_dz_png, filename='top_dz.png'))
-        except Exception:
-            try:
-                await bot.send_document(ADMIN_ID, InputFile(top_dz_png, filename='top_dz.png'))
-            except Exception:
-                pass
-        try:
-            await bot.send_photo(ADMIN_ID, photo=InputFile(top_cons_png, filename='top_cons.png'))
-        except Exception:
-            try:
-                await bot.send_document(ADMIN_ID, InputFile(top_cons_png, filename='top_cons.png'))
-            except Exception:
-                pass
+        # generate PNGs off the event loop (one at a time: matplotlib rendering is not thread-safe)
+        miss_png = await asyncio.to_thread(generate_miss_graph_by_student_png)
+        top_dz_png = await asyncio.to_thread(generate_top_students_png, 'dz')
+        top_cons_png = await asyncio.to_thread(generate_top_students_png, 'conspect')
+
+        # send to admin: three PNGs at once
+        await asyncio.gather(
+            send_admin_image(miss_png, 'misses_by_student.png'),
+            send_admin_image(top_dz_png, 'top_dz.png'),
+            send_admin_image(top_cons_png, 'top_cons.png'),
+        )
 
         # finally send the excel file
         try:
-            await bot.send_document(ADMIN_ID, InputFile(path, filename='full_history.xlsx'))
+            with open(path, 'rb') as f:
+                await bot.send_document(ADMIN_ID, InputFile(f, filename='full_history.xlsx'))
         except Exception:
             pass
 
@@ -1683,18 +2191,37 @@ async def update_full_history_daily():
 async def on_startup(dispatcher):
     scheduler.add_job(daily_reminder, "cron", hour=18, minute=0)
     scheduler.add_job(daily_admin_report, "cron", hour=23, minute=55)
-    scheduler.add_job(process_media_groups, "interval", seconds=2)
     scheduler.add_job(ask_missed_reason, "cron", hour=23, minute=57)
     # schedule full history daily update at 23:50
     scheduler.add_job(update_full_history_daily, 'cron', hour=23, minute=50)
+    scheduler.add_job(expire_flow_state, "interval", minutes=1)
     scheduler.start()
     logger.info("Scheduler started")
+    dispatcher["reasons_writer"] = asyncio.create_task(
+        batch_writer(reasons_write_q, _flush_reasons, REASONS_BATCH_WINDOW, REASONS_BATCH_MAX))
+    dispatcher["submissions_writer"] = asyncio.create_task(
+        batch_writer(submission_write_q, _flush_submissions, SUBMISSION_BATCH_WINDOW, SUBMISSION_BATCH_MAX))
+    spawn(asyncio.to_thread(warm_matplotlib))
+
+
+async def on_shutdown(dispatcher):
+    for name in ("reasons_writer", "submissions_writer"):
+        writer = dispatcher[name]
+        writer.cancel()
+        with suppress(asyncio.CancelledError):
+            await writer
+    # write whatever is still queued, then let queued DB work finish before the process exits
+    while not reasons_write_q.empty():
+        await _commit_batch(_flush_reasons, _drain_queue(reasons_write_q, [], REASONS_BATCH_MAX))
+    while not submission_write_q.empty():
+        await _commit_batch(_flush_submissions, _drain_queue(submission_write_q, [], SUBMISSION_BATCH_MAX))
+    db_executor.shutdown(wait=True)
 
 
 # - MAIN
 if __name__ == "__main__":
     print("Starting bot. Make sure API_TOKEN and ADMIN_ID are set in env.")
     print(f"ADMIN_ID: {ADMIN_ID}")
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
+    executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
 
 